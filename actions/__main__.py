@@ -1,5 +1,3 @@
-import asyncio
+from actions.supervisor import run
 
-from actions.main import main
-
-asyncio.run(main())
+run()
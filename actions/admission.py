@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import traceback
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from actions.config import parse_spec
+from actions.metrics import Counter, Histogram
+
+log = logging.getLogger("admission")
+
+# Defaults for every subscription, overridable per topic through
+# WORKER_LIMITS="<topic>=<max_inflight>:<max_queued>,...".
+MAX_INFLIGHT = int(os.environ.get("WORKER_MAX_INFLIGHT", "64"))
+MAX_QUEUED = int(os.environ.get("WORKER_MAX_QUEUED", "1024"))
+# Limits handed to the NATS client for messages not yet seen by our callback.
+PENDING_MSGS_LIMIT = int(os.environ.get("WORKER_PENDING_MSGS_LIMIT", "8192"))
+PENDING_BYTES_LIMIT = int(os.environ.get("WORKER_PENDING_BYTES_LIMIT", str(64 * 1024 * 1024)))
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[int, int]]:
+    return {
+        topic: (int(inflight or MAX_INFLIGHT), int(queued or MAX_QUEUED))
+        for topic, (inflight, queued) in parse_spec(spec, 2).items()
+    }
+
+
+TOPIC_LIMITS = parse_limits(os.environ.get("WORKER_LIMITS", ""))
+
+HANDLER_SECONDS = Histogram("actions_handler_seconds", "Message handler latency by topic")
+SHED_TOTAL = Counter("actions_shed_total", "Messages shed by admission control by topic")
+
+
+class Admission:
+    """
+    Runs the handlers of one subscription as tasks, at most `max_inflight` at
+    a time. Once `max_queued` messages wait for a slot further messages are
+    shed: `on_shed` is called instead of the handler. Without `shed` nothing
+    is, messages only queue up.
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        cb: Callable[..., Awaitable[None]],
+        on_shed: Optional[Callable[..., Awaitable[None]]] = None,
+        shed: bool = True,
+    ):
+        self.topic = topic
+        self.cb = cb
+        self.on_shed = on_shed
+        self.sheds = shed
+        self.max_inflight, self.max_queued = TOPIC_LIMITS.get(topic, (MAX_INFLIGHT, MAX_QUEUED))
+        self.sem = asyncio.Semaphore(self.max_inflight)
+        self.tasks: Set[asyncio.Future] = set()
+        self.inflight = 0
+        self.queued = 0
+        self.shed = 0
+
+    async def admit(self, msg):
+        if self.sheds and self.queued >= self.max_queued:
+            self.shed += 1
+            SHED_TOTAL.inc(topic=self.topic)
+            log.warning(f"Shedding message on {self.topic}, {self.queued} queued")
+            if self.on_shed is not None:
+                try:
+                    await self.on_shed(msg)
+                except Exception:
+                    traceback.print_exc()
+            return
+        self.queued += 1
+        task = asyncio.ensure_future(self._run(msg))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, msg):
+        async with self.sem:
+            self.queued -= 1
+            self.inflight += 1
+            try:
+                with HANDLER_SECONDS.time(topic=self.topic):
+                    await self.cb(msg)
+            finally:
+                self.inflight -= 1
+
+    async def drain(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "inflight": self.inflight,
+            "queued": self.queued,
+            "shed": self.shed,
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+# Sentinel for `ttl` arguments meaning "use the cache default".
+DEFAULT_TTL = object()
+
+
+class LRUCache:
+    """
+    Size bounded LRU with optional per-entry expiry. With `maxbytes` the
+    values, measured by `len`, are bounded too and a value larger than that
+    is not stored at all. Concurrent `get_or_fetch` calls for the same key
+    share a single in-flight fetch.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None, maxbytes: Optional[int] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, value, _ = entry
+        if expires is not None and expires < time.monotonic():
+            self.invalidate(key)
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl=DEFAULT_TTL):
+        if ttl is DEFAULT_TTL:
+            ttl = self.ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        size = 0
+        if self.maxbytes is not None:
+            size = len(value)
+            if size > self.maxbytes:
+                self.invalidate(key)
+                return
+        self.invalidate(key)
+        self.entries[key] = (expires, value, size)
+        self.bytes += size
+        while len(self.entries) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    async def get_or_fetch(
+        self,
+        key,
+        fetch: Callable[[], Awaitable[Any]],
+        ttl=DEFAULT_TTL,
+    ):
+        """
+        Return the cached value for `key`, calling `fetch` on a miss. None is
+        never cached, and with `ttl=0` the fetch is only shared, not stored.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            self.hits += 1
+            return value
+
+        fut = self.inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            fut = asyncio.ensure_future(self._fetch(key, fetch, ttl))
+            self.inflight[key] = fut
+            fut.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shielded so one cancelled waiter does not cancel the shared fetch.
+        return await asyncio.shield(fut)
+
+    async def _fetch(self, key, fetch, ttl):
+        value = await fetch()
+        if value is not None and ttl != 0:
+            self.put(key, value, ttl)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        stats = {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+        if self.maxbytes is not None:
+            stats["bytes"] = self.bytes
+        return stats
@@ -0,0 +1,16 @@
+"""
+Parsing of per key overrides in environment variables.
+"""
+from typing import Dict, List
+
+
+def parse_spec(spec: str, fields: int) -> Dict[str, List[str]]:
+    """
+    Parse "<key>=<value>:<value>...,..." into {key: values}, with exactly
+    `fields` values per key. Missing values are "" so callers can default them.
+    """
+    parsed = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        key, _, values = item.partition("=")
+        parsed[key] = (values.split(":") + [""] * fields)[:fields]
+    return parsed
@@ -0,0 +1,331 @@
+"""
+An in-process JobStore for single node deployments and tests. State lives in
+memory and every change is appended to a memory-mapped journal, which is
+replayed on startup to recover from a crash.
+"""
+import heapq
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Dict, Optional
+
+import msgpack
+
+from actions.store import STORAGE_EXPIRY, JobStore
+
+log = logging.getLogger("embedded")
+
+# The journal file grows in steps of this many bytes.
+JOURNAL_CHUNK = int(os.environ.get("EMBEDDED_JOURNAL_CHUNK", str(16 * 1024 * 1024)))
+# Rewrite the journal from live state once it is this large and twice the
+# size it had after the previous rewrite.
+COMPACT_BYTES = int(os.environ.get("EMBEDDED_COMPACT_BYTES", str(64 * 1024 * 1024)))
+# msync after every change. Without it changes survive a process crash but
+# not losing the machine.
+JOURNAL_SYNC = os.environ.get("EMBEDDED_JOURNAL_SYNC", "0") == "1"
+
+HEADER = struct.Struct("<II")
+
+
+def _b(v):
+    if isinstance(v, bytes):
+        return v
+    if isinstance(v, str):
+        return v.encode("utf-8")
+    return str(v).encode("utf-8")
+
+
+class Journal:
+    """
+    Append-only msgpack records in a memory-mapped file, each framed as
+    <length><crc32><payload>. The file is zero filled past the last record, so
+    replay stops at a zero length, or at a record torn by a crash.
+    """
+
+    def __init__(self, path, sync=JOURNAL_SYNC):
+        self.path = path
+        self.sync = sync
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        self.map = None
+        self.offset = 0
+        if self.size == 0:
+            self._grow(JOURNAL_CHUNK)
+        else:
+            self.map = mmap.mmap(self.fd, self.size)
+
+    def _grow(self, n):
+        if self.map is not None:
+            self.map.close()
+        self.size += -(-n // JOURNAL_CHUNK) * JOURNAL_CHUNK
+        os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def replay(self):
+        """Yield every intact record, leaving the journal positioned after them."""
+        offset = 0
+        while offset + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(self.map, offset)
+            start = offset + HEADER.size
+            if length == 0:
+                break
+            end = min(start + length, self.size)
+            if end != start + length or zlib.crc32(self.map[start:end]) != crc:
+                log.warning(f"Discarding torn journal record at {offset} in {self.path}")
+                self.map[offset:end] = bytes(end - offset)
+                break
+            yield msgpack.unpackb(self.map[start:end], use_list=True)
+            offset = end
+        self.offset = offset
+
+    def append(self, record):
+        payload = msgpack.packb(record)
+        n = HEADER.size + len(payload)
+        if self.offset + n > self.size:
+            self._grow(n)
+        start = self.offset + HEADER.size
+        self.map[start:start + len(payload)] = payload
+        HEADER.pack_into(self.map, self.offset, len(payload), zlib.crc32(payload))
+        self.offset += n
+        if self.sync:
+            self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        os.close(self.fd)
+
+
+class EmbeddedStore(JobStore):
+    """
+    JobStore kept in this process. Without `path` nothing is persisted.
+    Locks and membership are not journaled, they die with the process anyway.
+    Neither are claims: after a restart claimed jobs are simply due again.
+    """
+
+    def __init__(self, path=None, expiry=STORAGE_EXPIRY, clock=time.time):
+        self.expiry = expiry
+        self.clock = clock
+        self.hashes: Dict[str, Dict[str, bytes]] = {}
+        self.expires: Dict[str, float] = {}
+        self.sets: Dict[str, set] = {}
+        self.schedule: Dict[str, float] = {}
+        self.heap = []
+        self.locks: Dict[str, tuple] = {}
+        self.blobs: Dict[str, tuple] = {}
+        self.nodes: Dict[str, float] = {}
+        self.path = path
+        self.journal = None
+        self.compacted = 0
+        if path is not None:
+            self.journal = Journal(path)
+            for record in self.journal.replay():
+                self._apply(record)
+            self.compacted = self.journal.offset
+            log.info(f"Recovered {len(self.hashes)} jobs from {path}")
+
+    # Mutations, applied the same way live and on replay.
+
+    def _apply(self, record):
+        op = record[0]
+        if op == "h":
+            _, jid, fields, expires = record
+            self.hashes.setdefault(jid, {}).update((k, _b(v)) for k, v in fields.items())
+            self.expires[jid] = expires
+        elif op == "w":
+            _, jid, fields, move, src, dst, schedule, expires = record
+            self._apply(("h", jid, fields, expires))
+            if move == "move":
+                self.sets.setdefault(src, set()).discard(jid)
+            if move:
+                self.sets.setdefault(dst, set()).add(jid)
+            if schedule == "rem":
+                self.schedule.pop(jid, None)
+            elif schedule is not None:
+                self._schedule(jid, float(schedule))
+        elif op == "s":
+            _, state, jids = record
+            self.sets.setdefault(state, set()).update(jids)
+        elif op == "z":
+            _, jid, score = record
+            self._schedule(jid, score)
+        elif op == "b":
+            _, address, data, expires = record
+            self.blobs[address] = (data, expires)
+
+    def _log(self, record):
+        self._apply(record)
+        if self.journal is None:
+            return
+        self.journal.append(record)
+        if self.journal.offset > max(COMPACT_BYTES, 2 * self.compacted):
+            self.compact()
+
+    def _schedule(self, jid, score):
+        self.schedule[jid] = score
+        heapq.heappush(self.heap, (score, jid))
+        if len(self.heap) > 2 * len(self.schedule) + 64:
+            self.heap = [(s, j) for j, s in self.schedule.items()]
+            heapq.heapify(self.heap)
+
+    def _hash(self, jid):
+        data = self.hashes.get(jid)
+        if data is not None and self.expires.get(jid, 0) <= self.clock():
+            del self.hashes[jid]
+            del self.expires[jid]
+            return None
+        return data
+
+    def _holder(self, jid):
+        lock = self.locks.get(jid)
+        if lock is None:
+            return None
+        if lock[1] <= time.monotonic():
+            del self.locks[jid]
+            return None
+        return lock[0]
+
+    def compact(self):
+        """Rewrite the journal as just the records needed for the live state."""
+        tmp = f"{self.path}.compact"
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        journal = Journal(tmp, sync=False)
+        now = self.clock()
+        for jid in list(self.hashes):
+            if (data := self._hash(jid)) is not None:
+                journal.append(("h", jid, data, self.expires[jid]))
+        for state, jids in self.sets.items():
+            journal.append(("s", state, list(jids)))
+        for jid, score in self.schedule.items():
+            journal.append(("z", jid, score))
+        for address, (data, expires) in list(self.blobs.items()):
+            if expires > now:
+                journal.append(("b", address, data, expires))
+            else:
+                del self.blobs[address]
+        journal.map.flush()
+        os.fsync(journal.fd)
+        os.replace(tmp, self.path)
+        self.journal.close()
+        self.journal = journal
+        self.journal.path = self.path
+        self.journal.sync = JOURNAL_SYNC
+        self.compacted = journal.offset
+        log.info(f"Compacted {self.path} to {self.compacted} bytes")
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    # JobStore
+
+    async def acquire_locks(self, jids, lease_ms):
+        fences = []
+        for jid in jids:
+            if self._holder(jid) is not None:
+                fences.append(None)
+                continue
+            data = self._hash(jid) or {}
+            fence = int(data.get("lease", 0)) + 1
+            self._log(("h", jid, {"lease": fence}, self.clock() + self.expiry))
+            self.locks[jid] = (str(fence), time.monotonic() + lease_ms / 1000)
+            fences.append(fence)
+        return fences
+
+    async def renew_locks(self, locks, lease_ms):
+        res = []
+        for jid, token in locks:
+            ok = self._holder(jid) == token
+            if ok:
+                self.locks[jid] = (token, time.monotonic() + lease_ms / 1000)
+            res.append(ok)
+        return res
+
+    async def release_locks(self, locks):
+        res = []
+        for jid, token in locks:
+            ok = self._holder(jid) == token
+            if ok:
+                del self.locks[jid]
+            res.append(ok)
+        return res
+
+    async def write(self, writes):
+        res = []
+        for w in writes:
+            fields = dict(w.fields)
+            if w.token:
+                holder = self._holder(w.jid)
+                if holder is not None and holder != w.token:
+                    res.append(False)
+                    continue
+                data = self._hash(w.jid) or {}
+                if int(w.token) < int(data.get("fence", 0)):
+                    res.append(False)
+                    continue
+                fields["fence"] = w.token
+            self._log(("w", w.jid, fields, w.move, w.src, w.dst, w.schedule, self.clock() + self.expiry))
+            res.append(True)
+        return res
+
+    async def hget(self, jid, key):
+        data = self._hash(jid)
+        return None if data is None else data.get(key)
+
+    async def hgetall(self, jids):
+        return [dict(self._hash(jid) or {}) for jid in jids]
+
+    async def claim_due(self, now, n, until):
+        due = []
+        while self.heap and len(due) < n:
+            score, jid = self.heap[0]
+            if self.schedule.get(jid) != score:
+                heapq.heappop(self.heap)
+                continue
+            if score > now:
+                break
+            heapq.heappop(self.heap)
+            self._schedule(jid, until)
+            due.append(jid)
+        return due
+
+    async def next_deadline(self):
+        while self.heap:
+            score, jid = self.heap[0]
+            if self.schedule.get(jid) == score:
+                return score
+            heapq.heappop(self.heap)
+        return None
+
+    async def backfill_schedule(self, states, now):
+        for state in states:
+            for jid in list(self.sets.get(state, ())):
+                if jid not in self.schedule:
+                    self._log(("z", jid, now))
+
+    async def put_blob(self, address, data):
+        self._log(("b", address, data, self.clock() + self.expiry))
+
+    async def get_blob(self, address) -> Optional[bytes]:
+        blob = self.blobs.get(address)
+        if blob is None or blob[1] <= self.clock():
+            return None
+        return blob[0]
+
+    async def heartbeat(self, node, now, ttl):
+        self.nodes[node] = now
+        for member, seen in list(self.nodes.items()):
+            if seen < now - ttl:
+                del self.nodes[member]
+        return list(self.nodes)
+
+    async def members(self, now, ttl):
+        return [member for member, seen in self.nodes.items() if seen >= now - ttl]
+
+    async def leave(self, node):
+        self.nodes.pop(node, None)
@@ -1,42 +1,139 @@
-from typing import Optional
+import os
+from typing import Iterable, Optional
 
+import msgpack
 import orjson
 from nats.aio.client import Client as NATS
 
+from actions.cache import LRUCache
+from actions.metrics import Histogram
+
 CFS_GET = "conthesis.cfs.get"
 CFS_READLINK = "conthesis.cfs.readlink"
+CFS_RESOLVE = "conthesis.cfs.resolve"
+
+CFS_CACHE_SIZE = int(os.environ.get("CFS_CACHE_SIZE", "4096"))
+# Bytes of entity data cached at most. Larger entities are not cached at all.
+CFS_CACHE_BYTES = int(os.environ.get("CFS_CACHE_BYTES", str(256 * 1024 * 1024)))
+# Seconds a mutable path or symlink is trusted before asking CFS again.
+CFS_CACHE_TTL = float(os.environ.get("CFS_CACHE_TTL", "2"))
+# When set, `prefetch` asks CFS for several paths at once by sending a msgpack
+# array of paths to CFS_GET and expecting an array of entities (nil if missing)
+# back in the same order. Needs a CFS that understands that request shape.
+CFS_MULTI_GET = os.environ.get("CFS_MULTI_GET", "") not in ("", "0")
+# When set, `resolve` sends a path to CFS_RESOLVE and expects a msgpack
+# [target, entity] pair back, saving the readlink round trip before a get.
+CFS_RESOLVE_GET = os.environ.get("CFS_RESOLVE_GET", "") not in ("", "0")
+
+CFS_SECONDS = Histogram("actions_cfs_seconds", "CFS request latency by operation")
 
 def jsonize(data):
     if data is None:
             return None
     return orjson.loads(data)
 
+def _as_bytes(path):
+    return path.encode("utf-8") if isinstance(path, str) else path
+
 class EntityFetcher:
     nc: NATS
 
-    def __init__(self, nc: NATS):
+    def __init__(self, nc: NATS, resolve_get: bool = CFS_RESOLVE_GET):
         self.nc = nc
+        self.resolve_get = resolve_get
+        self.entities = LRUCache(CFS_CACHE_SIZE, CFS_CACHE_TTL, maxbytes=CFS_CACHE_BYTES)
+        self.links = LRUCache(CFS_CACHE_SIZE, CFS_CACHE_TTL)
 
-    async def fetch_path(self, path):
-        path = path.encode("utf-8") if isinstance(path, str) else path
-        res = await self.nc.request(CFS_GET, path)
+    async def _get(self, path: bytes) -> Optional[bytes]:
+        with CFS_SECONDS.time(op="get"):
+            res = await self.nc.request(CFS_GET, path)
         if res.data is None or len(res.data) == 0:
             print(f"Not found {path}")
             return None
         else:
             return res.data
 
-    async def readlink(self, path: str) -> str:
-        p  = path.encode("utf-8")
-        res = await self.nc.request(CFS_READLINK, p)
+    async def fetch_path(self, path, immutable=False):
+        """
+        Fetch the entity at `path`. Pass `immutable=True` for content addresses
+        (readlink targets), which are then cached until evicted rather than
+        for CFS_CACHE_TTL.
+        """
+        path = _as_bytes(path)
+        return await self.entities.get_or_fetch(
+            path,
+            lambda: self._get(path),
+            ttl=None if immutable else CFS_CACHE_TTL,
+        )
+
+    async def prefetch(self, paths: Iterable, immutable=False) -> None:
+        """Warm the entity cache for `paths` with a single multi-get request."""
+        missing = object()
+        wanted = []
+        for path in paths:
+            path = _as_bytes(path)
+            if path not in wanted and self.entities.get(path, missing) is missing:
+                wanted.append(path)
+        if not wanted:
+            return
+        with CFS_SECONDS.time(op="get_many"):
+            res = await self.nc.request(CFS_GET, msgpack.packb(wanted))
+        ttl = None if immutable else CFS_CACHE_TTL
+        for path, data in zip(wanted, msgpack.unpackb(res.data)):
+            if data:
+                self.entities.put(path, data, ttl)
+
+    async def _readlink(self, path: bytes) -> bytes:
+        with CFS_SECONDS.time(op="readlink"):
+            res = await self.nc.request(CFS_READLINK, path)
         data = res.data
         return data
 
-    async def fetch_path_json(self, path):
-        return jsonize(await self.fetch_path(path))
+    async def readlink(self, path: str) -> str:
+        p = _as_bytes(path)
+        return await self.links.get_or_fetch(p, lambda: self._readlink(p))
+
+    async def _resolve(self, path: bytes) -> bytes:
+        with CFS_SECONDS.time(op="resolve"):
+            res = await self.nc.request(CFS_RESOLVE, path)
+        target, data = msgpack.unpackb(res.data)
+        target = _as_bytes(target)
+        if data:
+            self.entities.put(target, data, None if target != path else CFS_CACHE_TTL)
+        return target
+
+    async def resolve(self, path):
+        """
+        Readlink `path` and fetch the entity it points at, returning both.
+        With `resolve_get` a link cache miss costs one CFS request, not two.
+        """
+        p = _as_bytes(path)
+        fetch = self._resolve if self.resolve_get else self._readlink
+        target = await self.links.get_or_fetch(p, lambda: fetch(p))
+        return target, await self.fetch_path(target, immutable=target != p)
+
+    async def fetch_blob(self, address: str, blobs) -> Optional[bytes]:
+        """Fetch a frozen entity from the job blob store; blobs never change."""
+        return await self.entities.get_or_fetch(
+            ("blob", address), lambda: blobs.get_blob(address), ttl=None,
+        )
+
+    async def fetch_path_json(self, path, immutable=False):
+        return jsonize(await self.fetch_path(path, immutable=immutable))
 
     async def fetch(self, entity: str) -> Optional[bytes]:
         return await self.fetch_path(f"/entity/{entity}".encode("utf-8"))
 
     async def fetch_json(self, entity: str) -> Optional[dict]:
         return jsonize(await self.fetch(entity))
+
+    def invalidate(self, path):
+        path = _as_bytes(path)
+        self.entities.invalidate(path)
+        self.links.invalidate(path)
+
+    def stats(self):
+        return {
+            "entities": self.entities.stats(),
+            "links": self.links.stats(),
+        }
@@ -2,22 +2,76 @@ import msgpack
 import time
 import asyncio
 import os
-import aredis
 import traceback
-from .model import Action, ActionTrigger, ActionProperty
-from transitions import Transition
-from transitions.extensions.asyncio import AsyncMachine
+from .metrics import Counter, Histogram
+from .retry import breaker, retry_policy
+from .store import Write, store_from_env
+from .model import (
+    pack_action,
+    pack_properties,
+    pack_trigger,
+    unpack_action,
+    unpack_properties,
+    unpack_trigger,
+)
 from enum import Enum
 from typing import Any, Optional
 import logging
 
 log = logging.getLogger("jobs")
 
+STORAGE_SECONDS = Histogram("actions_storage_seconds", "Job storage round trips by operation")
+TRANSITION_SECONDS = Histogram("actions_transition_seconds", "Job state transitions including callbacks")
+LOCK_FAILURES = Counter("actions_lock_failures_total", "Job locks that were already held by someone else")
+SESSIONS = Counter("actions_sessions_total", "Job sessions by whether a locally owned lock was reused")
+SCHEDULED_SECONDS = Histogram("actions_scheduled_job_seconds", "Scheduler processing time per due job")
+
 
 JOB_LOCK_LEASE_TIMEOUT = 5
 
+# How often a blocking lock acquisition retries.
+JOB_LOCK_RETRY_INTERVAL = 0.1
+
+# Held leases are extended this often, well before they run out.
+JOB_LOCK_RENEW_INTERVAL = JOB_LOCK_LEASE_TIMEOUT / 3
+
+# After a session the node keeps the job locked with an in-memory snapshot for
+# this many seconds, so follow-up sessions here skip lock and load round trips.
+# Sessions elsewhere wait for it to lapse; 0 disables.
+JOB_OWNERSHIP_LINGER = float(os.environ.get("JOB_OWNERSHIP_LINGER", "2"))
+JOB_OWNERSHIP_SIZE = int(os.environ.get("JOB_OWNERSHIP_SIZE", "10000"))
+
 JOB_RUNNING_TIMEOUT = 30
 
+# How long a job sits in PENDING/VARIABLES_LOADED before the scheduler picks
+# it up again, in case the node that registered it died halfway.
+JOB_STALLED_RECHECK = 5
+
+# Due jobs are claimed by pushing their deadline this far into the future, so
+# a node that dies mid-batch does not lose them.
+JOB_CLAIM_TIMEOUT = 10
+
+SCHEDULER_BATCH_SIZE = 50
+
+# Cap on due jobs processed concurrently out of one scheduler batch.
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "10"))
+
+# Upper bound on how long the scheduler sleeps; deadlines added by other nodes
+# are only noticed on wakeup.
+SCHEDULER_MAX_IDLE = 5
+
+# Seconds a job may spend proceeding through states in one call, per call site.
+REGISTER_TIMEOUT = float(os.environ.get("JOB_REGISTER_TIMEOUT", "3"))
+PROCESS_TIMEOUT = float(os.environ.get("JOB_PROCESS_TIMEOUT", "3"))
+RESUME_TIMEOUT = float(os.environ.get("JOB_RESUME_TIMEOUT", "3"))
+
+# Cap on jobs of one trigger batch processed concurrently.
+REGISTER_BATCH_CONCURRENCY = int(os.environ.get("REGISTER_BATCH_CONCURRENCY", "32"))
+
+# Checkpoint deltas are stored as fields of their own and folded into the
+# base checkpoint once this many have piled up.
+CHECKPOINT_DELTAS = int(os.environ.get("JOB_CHECKPOINT_DELTAS", "16"))
+
 def ts_now():
     return int(time.time())
 
@@ -25,6 +79,10 @@ def ts_now():
 class UnableToAcquireLockError(Exception):
     pass
 
+class StaleLockError(Exception):
+    """A write was fenced off because another worker has since taken the job."""
+    pass
+
 class DataMissing(Exception):
     pass
 
@@ -37,59 +95,193 @@ class VariablesDataMissing(DataMissing):
 class JobsManager:
     def __init__(self, svc):
         self.svc = svc
-        redis = aredis.StrictRedis.from_url(os.environ["REDIS_URL"])
-        self.storage = Storage(redis)
+        self.storage = Storage(store_from_env(), on_schedule=self._on_schedule)
         self.run = True
+        self.wakeup = asyncio.Event()
+        self.sleeping_until = None
+        self.check_sem = asyncio.Semaphore(SCHEDULER_CONCURRENCY)
+        self.last_batch = None
+        self.periodic = None
 
-    async def register(self, trigger):
+    async def register(self, trigger, timeout=REGISTER_TIMEOUT):
         async with JidSession(self.svc, self.storage, trigger.jid) as j:
             await j.storage.set_trigger(trigger) # TODO: Ugly check this.
-            time_remaining = await _in_x_seconds(3)
-            await j.process(time_remaining)
+            await j.process(Deadline(timeout))
+
+    async def register_many(self, triggers, timeout=REGISTER_TIMEOUT):
+        """
+        Register a batch of triggers, taking their locks, loading their state,
+        flushing and releasing with one pipeline each. Returns a status per
+        trigger, in order: "ok", "locked" if another worker holds the job,
+        "duplicate" if an earlier trigger in the batch has the same jid, or
+        "error".
+        """
+        acks = [None] * len(triggers)
+        first = {}
+        for i, trigger in enumerate(triggers):
+            if trigger.jid in first:
+                acks[i] = "duplicate"
+            else:
+                first[trigger.jid] = i
+        unique = list(first.values())
+        locks = await self.storage.lock_many([triggers[i].jid for i in unique])
+        held = []
+        busy = []
+        for i, lock in zip(unique, locks):
+            if lock is None:
+                LOCK_FAILURES.inc(op="register_many")
+                acks[i] = "locked"
+            elif not await self.storage.enter_session(triggers[i].jid, blocking=False):
+                # A local session is already waiting for this job.
+                LOCK_FAILURES.inc(op="register_many")
+                acks[i] = "locked"
+                busy.append(lock)
+            else:
+                held.append((i, lock))
+        if busy:
+            await self.storage.unlock_many(busy)
+        if not held:
+            return acks
+
+        try:
+            snapshots = await self.storage.get_all_many([triggers[i].jid for i, _ in held])
+            sessions = []
+            for (i, lock), snapshot in zip(held, snapshots):
+                jid_storage = JidStorage(triggers[i].jid, self.storage, lock=lock)
+                jid_storage.warm(snapshot)
+                sessions.append(JidSession(self.svc, self.storage, triggers[i].jid, jid_storage=jid_storage))
+
+            sem = asyncio.Semaphore(REGISTER_BATCH_CONCURRENCY)
+            unstaged = set()
+
+            async def register_one(i, session):
+                trigger = triggers[i]
+                async with sem:
+                    try:
+                        session.open()
+                        try:
+                            await session.job.storage.set_trigger(trigger)
+                            await session.job.process(Deadline(timeout))
+                            acks[i] = "ok"
+                        except Exception:
+                            log.error(f"Error registering jid={trigger.jid}")
+                            traceback.print_exc()
+                            acks[i] = "error"
+                        await session.close()
+                    except Exception:
+                        log.error(f"Error staging jid={trigger.jid}")
+                        traceback.print_exc()
+                        acks[i] = "error"
+                        unstaged.add(i)
+
+            await asyncio.gather(*[register_one(i, session) for (i, _), session in zip(held, sessions)])
+            # Jobs whose state could not be staged are left as they were.
+            flushed = [(i, s) for (i, _), s in zip(held, sessions) if i not in unstaged]
+            written = await self.storage.set_many([s.jid_storage.take_flush() for _, s in flushed])
+            for (i, _), ok in zip(flushed, written):
+                if not ok:
+                    acks[i] = "locked"
+        finally:
+            try:
+                await self.storage.unlock_many([lock for _, lock in held])
+            finally:
+                for i, _ in held:
+                    self.storage.exit_session(triggers[i].jid)
+        return acks
 
-    async def process(self, jid, src_state=None, blocking=True):
+    async def process(self, jid, src_state=None, blocking=True, timeout=PROCESS_TIMEOUT):
         async with JidSession(self.svc, self.storage, jid, blocking=blocking, src_state=src_state) as j:
-            time_remaining = await _in_x_seconds(3)
-            await j.process(time_remaining)
+            await j.process(Deadline(timeout))
 
-    async def resume(self, jid, data):
+    async def resume(self, jid, data, timeout=RESUME_TIMEOUT):
+        result, data = response_result(data)
         async with JidSession(self.svc, self.storage, jid) as j:
-            time_remaining = await _in_x_seconds(3)
-            await j.resume_and_process(time_remaining, "success", data)
+            await j.resume_and_process(Deadline(timeout), result, data)
 
     async def setup(self):
+        await self.storage.backfill_schedule(ACTIVE_STATES)
         self.periodic = asyncio.create_task(self.periodic_check_loop())
 
     async def periodic_check_loop(self):
-        log.info("Periodic check running")
-        while True:
+        log.info("Job scheduler running")
+        while self.run:
+            n_jobs = 0
             try:
-                await self.periodic_check()
+                n_jobs = await self.periodic_check()
             except Exception:
                 traceback.print_exc()
-            for i in range(5):
-                await asyncio.sleep(1)
-                if not self.run:
-                    return
+            if n_jobs < SCHEDULER_BATCH_SIZE:
+                await self.wait_for_next_deadline()
 
-    async def stop():
+    async def wait_for_next_deadline(self):
+        delay = SCHEDULER_MAX_IDLE
+        try:
+            deadline = await self.storage.next_deadline()
+            if deadline is not None:
+                delay = min(delay, max(0, deadline - time.time()))
+        except Exception:
+            traceback.print_exc()
+
+        self.wakeup.clear()
+        self.sleeping_until = time.time() + delay
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.sleeping_until = None
+
+    def _on_schedule(self, deadline):
+        if self.sleeping_until is not None and deadline < self.sleeping_until:
+            self.wakeup.set()
+
+    async def stop(self):
+        """Let the scheduler finish its batch, then release every owned job."""
         self.run = False
-        await self.periodic
+        self.wakeup.set()
+        if self.periodic is not None:
+            await self.periodic
+        await self.storage.disown_all()
 
     async def periodic_check(self):
-        for status in [Status.RUNNING, Status.PENDING, Status.RETRY]:
-            jobs = await self.storage.random_sample(status)
-            n_jobs = len(jobs)
-            if n_jobs > 0:
-                log.info(f"Found {n_jobs} jobs with state {status}")
-            for jid in jobs:
-                try:
-                    await self.process(jid.decode("utf-8"), blocking=False, src_state=status.value.encode("utf-8"))
-                except UnableToAcquireLockError:
-                    pass
-                except Exception:
-                    log.error(f"Error handling jid={jid}")
-                    traceback.print_exc()
+        jobs = await self.storage.claim_due(time.time(), SCHEDULER_BATCH_SIZE, JOB_CLAIM_TIMEOUT)
+        n_jobs = len(jobs)
+        if n_jobs == 0:
+            return 0
+        log.info(f"Found {n_jobs} due jobs")
+
+        start = time.monotonic()
+        latencies = await asyncio.gather(*[self.check_job(jid) for jid in jobs])
+        self.last_batch = BatchStats(latencies, time.monotonic() - start)
+        log.info(f"Processed batch {self.last_batch}")
+        return n_jobs
+
+    async def check_job(self, jid):
+        async with self.check_sem:
+            start = time.monotonic()
+            try:
+                await self.process(jid, blocking=False)
+            except UnableToAcquireLockError:
+                pass
+            except Exception:
+                log.error(f"Error handling jid={jid}")
+                traceback.print_exc()
+            latency = time.monotonic() - start
+            SCHEDULED_SECONDS.observe(latency)
+            return latency
+
+
+class BatchStats:
+    """Latencies of one scheduler batch, used to size SCHEDULER_CONCURRENCY."""
+    def __init__(self, latencies, wall):
+        latencies = sorted(latencies)
+        self.size = len(latencies)
+        self.wall = wall
+        self.p50 = latencies[self.size // 2]
+        self.max = latencies[-1]
+
+    def __str__(self):
+        return f"n={self.size} wall={self.wall:.3f}s p50={self.p50:.3f}s max={self.max:.3f}s"
 
 
 class Status(Enum):
@@ -103,107 +295,480 @@ class Status(Enum):
     REVOKED = "REVOKED"
 
 
-def make_status_machine(model, initial=None):
-    # The states
-    S = Status
-    events = [
-        { "trigger": "proceed", "source": [S.PENDING], "dest": S.VARIABLES_LOADED, "before": "load_data"},
-        { "trigger": "proceed", "source": [S.VARIABLES_LOADED, S.RETRY], "dest": S.RUNNING, "after": "start_run"},
-        { "trigger": "suspend", "source": [S.RUNNING], "dest": S.RUNNING },
-        { "trigger": "succeeded", "source": [S.RUNNING], "dest": S.SUCCESS },
-        { "trigger": "expired", "source": [S.PENDING, S.RETRY], "dest": S.FAILURE },
-        { "trigger": "error", "source": [S.RUNNING], "dest": S.RETRY },
-        { "trigger": "revoke", "source": [S.PENDING, S.VARIABLES_LOADED, S.RUNNING, S.RETRY], "dest": S.REVOKED},
-    ]
+ACTIVE_STATES = [Status.PENDING, Status.VARIABLES_LOADED, Status.RUNNING, Status.RETRY]
+FINAL_STATES = [Status.SUCCESS, Status.FAILURE, Status.REVOKED]
+
+
+S = Status
+STATUS_EVENTS = [
+    { "trigger": "proceed", "source": [S.PENDING], "dest": S.VARIABLES_LOADED, "before": "load_data"},
+    { "trigger": "proceed", "source": [S.VARIABLES_LOADED, S.RETRY], "dest": S.RUNNING, "after": "start_run"},
+    { "trigger": "suspend", "source": [S.RUNNING], "dest": S.RUNNING, "after": "checkpoint" },
+    { "trigger": "succeeded", "source": [S.RUNNING], "dest": S.SUCCESS },
+    { "trigger": "expired", "source": [S.PENDING, S.RETRY], "dest": S.FAILURE },
+    { "trigger": "error", "source": [S.RUNNING], "dest": S.RETRY, "after": "schedule_retry" },
+    { "trigger": "revoke", "source": [S.PENDING, S.VARIABLES_LOADED, S.RUNNING, S.RETRY], "dest": S.REVOKED},
+]
+del S
+
+
+def compile_transitions(events):
+    """Flatten transition definitions into {trigger: {source: (dest, before, after)}}."""
+    table = {}
+    for event in events:
+        for source in event["source"]:
+            table.setdefault(event["trigger"], {})[source] = (
+                event["dest"], event.get("before"), event.get("after"),
+            )
+    return table
+
+
+STATUS_TRANSITIONS = compile_transitions(STATUS_EVENTS)
+
+
+async def fire_transition(model, trigger, *args, **kwargs):
+    """
+    Run `trigger` against `model.state`. Invalid triggers are ignored and
+    return False. A failing `before` callback leaves the state untouched, while
+    `after` runs once the model is already in the destination state.
+    """
+    transition = STATUS_TRANSITIONS[trigger].get(model.state)
+    if transition is None:
+        return False
+    dest, before, after = transition
+    with TRANSITION_SECONDS.time(trigger=trigger, source=model.state.value, dest=dest.value):
+        if before is not None:
+            await getattr(model, before)(*args, **kwargs)
+        model.state = dest
+        if after is not None:
+            await getattr(model, after)(*args, **kwargs)
+    return True
+
+
+def _trigger(name):
+    async def trigger(self, *args, **kwargs):
+        return await fire_transition(self, name, *args, **kwargs)
+    trigger.__name__ = name
+    return trigger
+
+class Deadline:
+    """A point `seconds` from now on the event loop clock."""
+    __slots__ = ("loop", "at")
 
-    if initial is None:
-        initial = S.PENDING
+    def __init__(self, seconds):
+        self.loop = asyncio.get_running_loop()
+        self.at = self.loop.time() + seconds
 
-    return AsyncMachine(model, states=Status, transitions=events, initial=initial, ignore_invalid_triggers=True)
+    def remaining(self):
+        return self.at - self.loop.time()
 
-async def _in_x_seconds(secs):
-    async def _inner(x):
-        await asyncio.sleep(x)
-    fut =  asyncio.create_task(_inner(secs))
-    return lambda: not fut.done()
+    def expired(self):
+        return self.loop.time() >= self.at
 
 class JidSession:
-    def __init__(self, service, storage, jid, blocking=True, src_state=None):
+    def __init__(self, service, storage, jid, blocking=True, src_state=None, jid_storage=None):
         self.service = service
         self.storage = storage
         self.jid = jid
-        self.jid_storage = JidStorage(self.jid, self.storage, src_state=src_state)
+        if jid_storage is None:
+            jid_storage = JidStorage(self.jid, self.storage, src_state=src_state)
+        self.jid_storage = jid_storage
         self.blocking = blocking
 
     async def __aenter__(self):
-        locked = await (await self.jid_storage.lock()).acquire(blocking=self.blocking)
+        # Sessions of one jid on this node queue up here instead of polling
+        # the job lock, which this node may well be holding or keeping itself.
+        if not await self.storage.enter_session(self.jid, blocking=self.blocking):
+            LOCK_FAILURES.inc(op="session")
+            raise UnableToAcquireLockError()
+        try:
+            return await self._enter_locked()
+        except BaseException:
+            self.storage.exit_session(self.jid)
+            raise
+
+    async def _enter_locked(self):
+        lock = self.storage.owned_lock(self.jid)
+        if lock is not None:
+            SESSIONS.inc(owned="yes")
+            lock.linger_until = None
+            self.jid_storage = JidStorage(self.jid, self.storage, lock=lock)
+            self.jid_storage.warm(lock.snapshot)
+            return self.open()
+
+        lock = await self.jid_storage.lock()
+        locked = await lock.acquire(blocking=self.blocking)
 
         if not locked:
+            LOCK_FAILURES.inc(op="session")
             raise UnableToAcquireLockError()
 
-        self.job = Job(self.jid, self.jid_storage, self.service, await self.jid_storage.get_state())
+        SESSIONS.inc(owned="no")
+        try:
+            await self.jid_storage.load()
+            self.open()
+        except Exception:
+            await lock.release()
+            raise
         return self.job
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self.jid_storage.set_state(self.job.state)
-        await self.jid_storage.flush()
-        await (await self.jid_storage.lock()).release()
+        lock = await self.jid_storage.lock()
+        snapshot = None
+        try:
+            await self.close()
+            if self.job.state not in FINAL_STATES:
+                snapshot = self.jid_storage.snapshot()
+            await self.jid_storage.flush()
+        except Exception:
+            snapshot = None
+            raise
+        finally:
+            try:
+                if snapshot is None or not self.storage.keep(lock, snapshot):
+                    self.storage.disown(lock)
+                    await lock.release()
+            finally:
+                self.storage.exit_session(self.jid)
+
+    def open(self):
+        """Build the job from already locked and loaded storage."""
+        self.job = Job(self.jid, self.jid_storage, self.service, self.jid_storage.state())
+        return self.job
 
-STORAGE_EXPIRY = 6 * 60 * 60
+    async def close(self):
+        """Stage the job's final state and next deadline for flushing."""
+        await self.jid_storage.set_state(self.job.state)
+        self.jid_storage.set_deadline(await self.job.next_deadline())
+
+def response_result(data):
+    """
+    Split an action response into the Job.resume result and its data. Long
+    running actions reply {"$suspend": delta} to checkpoint and keep the job
+    running, {"$error": ...} fails the attempt, anything else is the result.
+    """
+    if isinstance(data, dict):
+        if "$suspend" in data:
+            return "suspend", data["$suspend"]
+        if "$error" in data:
+            return "error", data["$error"]
+    return "success", data
+
+
+def merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7386): dicts merge, None deletes, the rest replaces."""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            result.pop(k, None)
+        else:
+            result[k] = merge_patch(result.get(k), v)
+    return result
+
+
+def _jid(jid):
+    return jid.decode("utf-8") if isinstance(jid, bytes) else jid
+
+
+class JobLock:
+    def __init__(self, storage, jid, token=None):
+        self.storage = storage
+        self.jid = jid
+        self.token = token
+        self.lost = False
+        # Local ownership, see Storage.keep.
+        self.snapshot = None
+        self.linger_until = None
+        if token is not None:
+            storage.hold(self)
+
+    async def acquire(self, blocking=True):
+        while True:
+            token = await self.storage.try_lock(self.jid)
+            if token is not None:
+                break
+            if not blocking:
+                return False
+            await asyncio.sleep(JOB_LOCK_RETRY_INTERVAL)
+        self.token = token
+        self.lost = False
+        self.storage.hold(self)
+        return True
+
+    async def release(self):
+        if self.token is None:
+            return
+        self.storage.unhold(self)
+        if not await self.storage.unlock(self.jid, self.token):
+            log.warning(f"Lock for {self.jid} expired before it was released")
+        self.token = None
 
 class Storage:
-    def __init__(self, redis):
-        self.redis = redis
-
-    def _key(self, jid):
-        if isinstance(jid, bytes):
-            jid = jid.decode("utf-8")
-        return f"job-{jid}"
-
-    def _set_key(self, state):
-        return f"job-state-{state}"
+    def __init__(self, store, on_schedule=None):
+        self.store = store
+        self.on_schedule = on_schedule
+        self.held = set()
+        self.owned = {}
+        # jid -> [mutex, sessions entered or waiting], see JidSession.
+        self.sessions = {}
+        self.renewer = None
+        # Whether responses for a jid are routed to this node, see Partitions.
+        self.affinity = lambda jid: True
 
     async def lock(self, jid):
-        if isinstance(jid, bytes):
-            jid = jid.decode("utf-8")
-        return self.redis.lock(f"job-lock-{jid}", timeout=JOB_LOCK_LEASE_TIMEOUT)
-
-    async def set(self, jid, params, src_state):
-        if isinstance(jid, bytes):
-            jid = jid.decode("utf-8")
+        return JobLock(self, jid)
+
+    async def try_lock(self, jid):
+        """Take the lock of `jid`, returning its fencing token or None if held."""
+        with STORAGE_SECONDS.time(op="try_lock"):
+            (fence,) = await self.store.acquire_locks([_jid(jid)], JOB_LOCK_LEASE_TIMEOUT * 1000)
+            return None if fence is None else str(fence)
+
+    async def unlock(self, jid, token):
+        with STORAGE_SECONDS.time(op="unlock"):
+            (ok,) = await self.store.release_locks([(_jid(jid), token)])
+            return ok
+
+    async def lock_many(self, jids):
+        """Try to take the locks of all `jids` at once, None where already held."""
+        with STORAGE_SECONDS.time(op="lock_many"):
+            fences = await self.store.acquire_locks([_jid(jid) for jid in jids], JOB_LOCK_LEASE_TIMEOUT * 1000)
+            return [
+                JobLock(self, jid, str(fence)) if fence is not None else None
+                for jid, fence in zip(jids, fences)
+            ]
 
-        await self.redis.hmset(self._key(jid), params)
-        await self.redis.expire(self._key(jid), STORAGE_EXPIRY)
+    async def unlock_many(self, locks):
+        with STORAGE_SECONDS.time(op="unlock_many"):
+            release = []
+            for lock in locks:
+                if lock.token is not None:
+                    self.unhold(lock)
+                    release.append((_jid(lock.jid), lock.token))
+                    lock.token = None
+            if release:
+                await self.store.release_locks(release)
+
+    async def enter_session(self, jid, blocking=True):
+        """Wait for other sessions of `jid` on this node; False if busy and not `blocking`."""
+        jid = _jid(jid)
+        entry = self.sessions.get(jid)
+        if entry is None:
+            entry = self.sessions[jid] = [asyncio.Lock(), 0]
+        elif not blocking and entry[0].locked():
+            return False
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self.exit_session(jid, acquired=False)
+            raise
+        return True
+
+    def exit_session(self, jid, acquired=True):
+        jid = _jid(jid)
+        entry = self.sessions[jid]
+        if acquired:
+            entry[0].release()
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.sessions[jid]
+
+    def in_session(self, jid):
+        return _jid(jid) in self.sessions
+
+    def hold(self, lock):
+        """Keep renewing `lock` until it is released."""
+        self.held.add(lock)
+        if self.renewer is None or self.renewer.done():
+            self.renewer = asyncio.ensure_future(self.renew_loop())
+
+    def unhold(self, lock):
+        self.held.discard(lock)
+
+    def owned_lock(self, jid):
+        """The lingering lock of `jid` if this node still owns it."""
+        lock = self.owned.get(jid)
+        if lock is None or lock.token is None or lock.lost:
+            return None
+        return lock
+
+    def keep(self, lock, snapshot):
+        """
+        Keep `lock` held after its session with the job's written state, until
+        JOB_OWNERSHIP_LINGER passes without another session. Returns False if
+        the lock should be released right away instead.
+        """
+        if not JOB_OWNERSHIP_LINGER or lock.lost or lock.token is None:
+            return False
+        if not self.affinity(lock.jid):
+            return False
+        lock.snapshot = snapshot
+        lock.linger_until = asyncio.get_running_loop().time() + JOB_OWNERSHIP_LINGER
+        self.owned.pop(lock.jid, None)
+        self.owned[lock.jid] = lock
+        if len(self.owned) > JOB_OWNERSHIP_SIZE:
+            oldest = next((l for l in self.owned.values() if not self.in_session(l.jid)), None)
+            if oldest is not None:
+                oldest.linger_until = 0
+        return True
+
+    def disown(self, lock):
+        if self.owned.get(lock.jid) is lock:
+            del self.owned[lock.jid]
+        lock.snapshot = None
+        lock.linger_until = None
+
+    async def disown_all(self):
+        """Release every lingering lock, e.g. on shutdown."""
+        await self.release_lingering(float("inf"))
+
+    async def release_lingering(self, now):
+        expired = [
+            lock for lock in list(self.owned.values())
+            if lock.linger_until is not None and lock.linger_until <= now and not self.in_session(lock.jid)
+        ]
+        for lock in expired:
+            self.disown(lock)
+        if expired:
+            await self.unlock_many(expired)
+
+    async def renew_loop(self):
+        while self.held:
+            await asyncio.sleep(JOB_LOCK_RENEW_INTERVAL)
+            try:
+                await self.release_lingering(asyncio.get_running_loop().time())
+                await self.renew(list(self.held))
+            except Exception:
+                traceback.print_exc()
 
+    async def renew(self, locks):
+        """Extend the leases of `locks` in one round trip, flagging the ones lost."""
+        with STORAGE_SECONDS.time(op="renew"):
+            res = await self.store.renew_locks(
+                [(_jid(lock.jid), lock.token) for lock in locks], JOB_LOCK_LEASE_TIMEOUT * 1000,
+            )
+        for lock, ok in zip(locks, res):
+            if not ok and lock.token is not None and not lock.lost:
+                log.warning(f"Lost lock for {lock.jid} while holding it")
+                lock.lost = True
+                # A session's flush is fenced by the token, never clear it under one.
+                if lock.linger_until is not None and not self.in_session(lock.jid):
+                    self.disown(lock)
+                    self.unhold(lock)
+                    lock.token = None
+
+    async def set(self, jid, params, src_state, deadline=None, token=None):
+        with STORAGE_SECONDS.time(op="set"):
+            write, deadline = self._write(jid, params, src_state, deadline, token)
+            (ok,) = await self.store.write([write])
+            if not ok:
+                raise StaleLockError(jid)
+
+            if deadline is not None and self.on_schedule is not None:
+                self.on_schedule(deadline)
+
+    async def set_many(self, writes):
+        """
+        Apply several `set` calls, given as argument tuples, in one round trip.
+        Returns per write whether it went through or was fenced off.
+        """
+        with STORAGE_SECONDS.time(op="set_many"):
+            built = [self._write(*write) for write in writes]
+            res = await self.store.write([write for write, _ in built])
+
+            if self.on_schedule is not None:
+                for (_, deadline), ok in zip(built, res):
+                    if ok and deadline is not None:
+                        self.on_schedule(deadline)
+            return res
+
+    def _write(self, jid, params, src_state, deadline, token):
+        """Build the store Write for a flush, plus the deadline it schedules."""
+        jid = _jid(jid)
+
+        move = ""
+        src = dst = None
         if "state" in params:
             dst = params["state"]
             if src_state is not None:
                 src = src_state.decode("utf-8")
                 if src != dst:
                     log.info(f"State for {jid} altered from {src} to {dst}")
-                    await self.redis.srem(self._set_key(src), jid)
-                    await self.redis.sadd(self._set_key(dst), jid)
+                    move = "move"
             else:
                 log.info(f"State for {jid} became {dst}")
-                await self.redis.sadd(self._set_key(dst), jid)
+                move = "add"
+
+        schedule = None
+        if dst is not None and Status(dst) in FINAL_STATES:
+            schedule = "rem"
+            deadline = None
+        elif deadline is not None:
+            schedule = deadline
+
+        return Write(jid, token, params, move, src, dst, schedule), deadline
 
     async def get(self, jid, key):
-        return await self.redis.hget(self._key(jid), key)
+        with STORAGE_SECONDS.time(op="get"):
+            return await self.store.hget(_jid(jid), key)
+
+    async def get_all(self, jid):
+        with STORAGE_SECONDS.time(op="get_all"):
+            (data,) = await self.store.hgetall([_jid(jid)])
+            return data
+
+    async def get_all_many(self, jids):
+        with STORAGE_SECONDS.time(op="get_all_many"):
+            return await self.store.hgetall([_jid(jid) for jid in jids])
+
+    async def claim_due(self, now, n, claim_for):
+        with STORAGE_SECONDS.time(op="claim_due"):
+            return await self.store.claim_due(now, n, now + claim_for)
+
+    async def next_deadline(self):
+        with STORAGE_SECONDS.time(op="next_deadline"):
+            return await self.store.next_deadline()
+
+    async def put_blob(self, address, data):
+        """Store content addressed `data`, shared by every job that froze it."""
+        with STORAGE_SECONDS.time(op="put_blob"):
+            await self.store.put_blob(address, data)
+
+    async def get_blob(self, address):
+        with STORAGE_SECONDS.time(op="get_blob"):
+            return await self.store.get_blob(address)
+
+    async def heartbeat(self, node, now, ttl):
+        """Mark `node` alive and return every member seen within `ttl` seconds."""
+        with STORAGE_SECONDS.time(op="heartbeat"):
+            return await self.store.heartbeat(node, now, ttl)
 
-    async def random_sample(self, state, n=15):
-        state_name = state if isinstance(state, str) else state.value
-        return await self.redis.srandmember(self._set_key(state_name), n)
+    async def members(self, now, ttl):
+        with STORAGE_SECONDS.time(op="members"):
+            return await self.store.members(now, ttl)
+
+    async def leave(self, node):
+        await self.store.leave(node)
+
+    async def backfill_schedule(self, states):
+        """Schedule jobs that predate the schedule set, leaving known ones be."""
+        await self.store.backfill_schedule([state.value for state in states], time.time())
 
 
 class JidStorage:
-    def __init__(self, jid, storage, src_state=None):
+    def __init__(self, jid, storage, src_state=None, lock=None):
         self.jid = jid
         self.storage = storage
         self.dirty = set()
         self.cached = {}
         self.src_state = src_state
         self.flushing = None
-        self._lock = None
+        self.loaded = False
+        self.deadline = None
+        self._lock = lock
 
     async def lock(self):
         if self._lock is None:
@@ -214,10 +779,44 @@ class JidStorage:
         if self.flushing is not None:
             raise RuntimeError("May not flush while flush is in progress")
 
-        flushed = { k: self.cached[k] for k in self.dirty }
-        await self.storage.set(self.jid, flushed, self.src_state)
+        await self.storage.set(*self.take_flush())
+
+    def take_flush(self):
+        """Return the pending write as `Storage.set` arguments and reset."""
+        flushed = (
+            self.jid,
+            { k: self.cached[k] for k in self.dirty },
+            self.src_state,
+            self.deadline,
+            self._lock.token if self._lock is not None else None,
+        )
         self.cached = {}
         self.dirty = set()
+        self.loaded = False
+        self.deadline = None
+        return flushed
+
+    def snapshot(self):
+        """The job hash as it will read back from Redis once flushed."""
+        return {
+            k: v.encode("utf-8") if isinstance(v, str) else v
+            for k, v in self.cached.items()
+        }
+
+    def set_deadline(self, deadline):
+        self.deadline = deadline
+
+    async def load(self):
+        """Warm the cache with the whole job hash in a single HGETALL."""
+        self.warm(await self.storage.get_all(self.jid))
+
+    def warm(self, data):
+        for k, v in data.items():
+            if k not in self.dirty:
+                self.cached[k] = v
+        if self.src_state is None:
+            self.src_state = self.cached.get("state")
+        self.loaded = True
 
     async def set(self, key: str, data: Any) -> None:
         self.dirty.add(key)
@@ -225,6 +824,8 @@ class JidStorage:
 
     async def get(self, key: str) -> Any:
         if key not in self.cached:
+            if self.loaded:
+                return None
             val = await self.storage.get(self.jid, key)
             self.cached[key] = val
             if self.src_state is None and key == "state":
@@ -237,34 +838,30 @@ class JidStorage:
         if data is None:
             return None
         try:
-            return ActionTrigger.from_bytes(data)
+            return unpack_trigger(data)
         except:
             log.error(f"Trigger was invalid JSON {data}")
             return None
 
 
     async def set_trigger(self, data):
-        return await self.set("trigger", data.to_bytes())
+        return await self.set("trigger", pack_trigger(data))
 
     async def get_action(self):
-        return Action.from_bytes(await self.get("action"))
+        return unpack_action(await self.get("action"))
 
     async def set_action(self, data):
-        return await self.set("action", data.to_bytes())
+        return await self.set("action", pack_action(data))
 
     async def get_variables(self):
         try:
-            vs = msgpack.unpackb(await self.get("variables"))
-            return [
-                ActionProperty.parse_obj(x)
-                for x in vs
-            ]
+            return unpack_properties(await self.get("variables"))
         except:
             raise VariablesDataMissing()
 
 
     async def set_variables(self, data):
-        return await self.set("variables", ActionProperty.many_to_bytes(data))
+        return await self.set("variables", pack_properties(data))
 
     async def set_timestamp(self, val):
         return await self.set("timestamp", str(val))
@@ -275,11 +872,61 @@ class JidStorage:
             return None
         return int(ts)
 
+    async def get_checkpoint(self):
+        """The base checkpoint with every delta since folded in, None if never suspended."""
+        checkpoint = await self.get("checkpoint")
+        if checkpoint is not None:
+            checkpoint = msgpack.unpackb(checkpoint)
+        for i in range(1, await self.get_checkpoint_deltas() + 1):
+            checkpoint = merge_patch(checkpoint, msgpack.unpackb(await self.get(f"checkpoint-{i}")))
+        return checkpoint
+
+    async def get_checkpoint_deltas(self):
+        n = await self.get("checkpoints")
+        return 0 if n is None else int(n)
+
+    async def add_checkpoint(self, delta):
+        """Store `delta` on its own, or fold it all into the base once CHECKPOINT_DELTAS pile up."""
+        n = await self.get_checkpoint_deltas() + 1
+        if n > CHECKPOINT_DELTAS:
+            checkpoint = merge_patch(await self.get_checkpoint(), delta)
+            await self.set("checkpoint", msgpack.packb(checkpoint))
+            n = 0
+        else:
+            await self.set(f"checkpoint-{n}", msgpack.packb(delta))
+        await self.set("checkpoints", str(n))
+
+    async def set_attempts(self, val):
+        return await self.set("attempts", str(val))
+
+    async def get_attempts(self):
+        attempts = await self.get("attempts")
+        if attempts is None:
+            return 0
+        return int(attempts)
+
+    async def set_retry_at(self, val):
+        return await self.set("retry_at", repr(val))
+
+    async def get_retry_at(self):
+        retry_at = await self.get("retry_at")
+        if retry_at is None:
+            return None
+        return float(retry_at)
+
     async def get_state(self):
-        state = await self.get("state")
+        if not self.loaded:
+            await self.get("state")
+        return self.state()
+
+    def state(self):
+        """The job state of a loaded job."""
+        state = self.cached.get("state")
         if state is None:
             return None
-        return Status(state.decode("utf-8"))
+        if isinstance(state, bytes):
+            state = state.decode("utf-8")
+        return Status(state)
 
     async def set_state(self, data):
         return await self.set("state", data.value)
@@ -287,9 +934,17 @@ class JidStorage:
 
 class Job:
     storage: JidStorage
+
+    proceed = _trigger("proceed")
+    suspend = _trigger("suspend")
+    succeeded = _trigger("succeeded")
+    expired = _trigger("expired")
+    error = _trigger("error")
+    revoke = _trigger("revoke")
+
     def __init__(self, jid, storage, service, initial):
         self.jid = jid
-        self.machine = make_status_machine(self, initial)
+        self.state = initial if initial is not None else Status.PENDING
         self.storage = storage
         self.service = service
 
@@ -301,27 +956,70 @@ class Job:
         await self.storage.set_action(action)
         if any(p is None for p in action.properties):
             log.error(f"Property in {action} was None")
-        variables = await self.service.freeze_properties(action.properties, trigger.meta)
+        variables = await self.service.freeze_properties(action.properties, trigger.meta, blobs=self.storage.storage)
         await self.storage.set_variables(variables)
 
 
     async def start_run(self):
         action = await self.storage.get_action()
         variables = await self.storage.get_variables()
-        resolved = await self.service.resolve_properties(variables)
+        resolved = await self.service.resolve_properties(variables, blobs=self.storage.storage)
+        # A retried job continues from where its last run checkpointed.
+        if (checkpoint := await self.storage.get_checkpoint()) is not None:
+            resolved["$checkpoint"] = checkpoint
         await self.service.perform_action_async(self.jid, action.kind, resolved)
         await self.storage.set_timestamp(ts_now())
 
-    async def proceed_many(self, time_remaining):
-        while time_remaining():
+    async def kind(self):
+        return (await self.storage.get_action()).kind
+
+    async def schedule_retry(self, *args):
+        """Count the failed attempt and back off before the next one."""
+        kind = await self.kind()
+        breaker(kind).record(False)
+        attempts = await self.storage.get_attempts() + 1
+        await self.storage.set_attempts(attempts)
+        await self.storage.set_retry_at(time.time() + retry_policy(kind).backoff(attempts))
+
+    async def retry_due(self):
+        """
+        Whether a RETRY job is done backing off. Once it has used up the
+        attempts of its action kind it is expired instead.
+        """
+        if await self.storage.get_attempts() >= retry_policy(await self.kind()).max_attempts:
+            log.info(f"Job {self.jid} ran out of attempts")
+            await self.expired()
+            return False
+        retry_at = await self.storage.get_retry_at()
+        return retry_at is None or retry_at <= time.time()
+
+    async def dispatch_allowed(self):
+        """Hold jobs back from action kinds whose circuit is open."""
+        b = breaker(await self.kind())
+        if b.allow():
+            return True
+        await self.storage.set_retry_at(time.time() + b.retry_after())
+        return False
+
+    async def checkpoint(self, delta=None):
+        """Record a suspended run's progress; it also counts as a heartbeat."""
+        if delta is not None:
+            await self.storage.add_checkpoint(delta)
+        await self.storage.set_timestamp(ts_now())
+
+    async def proceed_many(self, deadline):
+        while not deadline.expired():
             if self.state == Status.RUNNING:
                 return True
+            if self.state in (Status.VARIABLES_LOADED, Status.RETRY) and not await self.dispatch_allowed():
+                return True
             if not await self.proceed():
                 return True
         return False
 
 
     async def has_timed_out(self):
+        """Whether JOB_RUNNING_TIMEOUT passed since the last dispatch or checkpoint."""
         ts = await self.storage.get_timestamp()
         if ts is None:
             await self.storage.set_timestamp(ts_now())
@@ -332,9 +1030,28 @@ class Job:
         return elapsed > JOB_RUNNING_TIMEOUT
 
 
-    async def process(self, time_remaining):
+    async def next_deadline(self):
+        """When the scheduler should next look at this job, None if never."""
+        if self.state is Status.RUNNING:
+            ts = await self.storage.get_timestamp()
+            if ts is None:
+                ts = ts_now()
+            return ts + JOB_RUNNING_TIMEOUT + 1
+        elif self.state is Status.PENDING:
+            return ts_now() + JOB_STALLED_RECHECK
+        elif self.state is Status.VARIABLES_LOADED:
+            retry_at = await self.storage.get_retry_at()
+            return retry_at if retry_at is not None else ts_now() + JOB_STALLED_RECHECK
+        elif self.state is Status.RETRY:
+            retry_at = await self.storage.get_retry_at()
+            return retry_at if retry_at is not None else ts_now()
+        return None
+
+    async def process(self, deadline):
+        if self.state is Status.RETRY and not await self.retry_due():
+            return
         try:
-            if not await self.proceed_many(time_remaining):
+            if not await self.proceed_many(deadline):
                 return
         except DataMissing:
             log.error("Unable to fetch trigger data, revoking action")
@@ -344,20 +1061,22 @@ class Job:
             if await self.has_timed_out():
                 await self.error()
 
-        elif self.state is Status.RETRY:
-            await self.expired()
-
-    async def resume(self, time_remaining, result, data):
-        if not time_remaining():
+    async def resume(self, deadline, result, data):
+        if deadline.expired():
             return False
         if result == "suspend":
-            return await self.suspend(data)
+            ok = await self.suspend(data)
         elif result == "success":
-            return await self.succeeded()
+            ok = await self.succeeded()
         elif result == "error":
             return await self.error(data)
+        else:
+            return None
+        if ok:
+            breaker(await self.kind()).record(True)
+        return ok
 
-    async def resume_and_process(self, time_remaining, result, data):
-        if not await self.resume(time_remaining, result, data):
+    async def resume_and_process(self, deadline, result, data):
+        if not await self.resume(deadline, result, data):
             return False
-        return await self.process(time_remaining)
+        return await self.process(deadline)
@@ -1,43 +1,87 @@
 import asyncio
 import logging
 import os
+import signal
 
 from nats.aio.client import Client as NATS
 
+from . import metrics
 from .entity_fetcher import EntityFetcher
 from .service import Service
 from .worker import Worker
 from .jobs import JobsManager
+from .retry import BREAKERS
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
-logging.getLogger("transitions.extensions.asyncio").setLevel(logging.WARNING)
+log = logging.getLogger("main")
 
 
-async def main():
-    actions = Actions()
+async def main(index=0):
+    actions = Actions(index)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, actions.request_shutdown)
     await actions.setup()
     await actions.wait_for_shutdown()
 
 
 class Actions:
-    def __init__(self):
+    def __init__(self, index=0):
+        # Position among the processes of a Supervisor, 0 when run alone.
+        self.index = index
         self.shutdown_f = asyncio.get_running_loop().create_future()
+        self.stopping = None
+        self.metrics_server = None
         nats = NATS()
-        entity_fetcher = EntityFetcher(nats)
-        service = Service(nats, entity_fetcher)
-        self.jobs = JobsManager(service)
-        self.worker = Worker(nats, service, self.jobs)
+        self.entity_fetcher = EntityFetcher(nats)
+        self.service = Service(nats, self.entity_fetcher)
+        self.jobs = JobsManager(self.service)
+        self.worker = Worker(nats, self.service, self.jobs)
+        metrics.REGISTRY.collector(self.collect_metrics)
 
     async def setup(self):
         await self.worker.setup()
         await self.jobs.setup()
+        # Processes of one supervisor serve metrics on consecutive ports.
+        if metrics.METRICS_PORT:
+            self.metrics_server = await metrics.serve(metrics.METRICS_PORT + self.index)
+
+    def collect_metrics(self):
+        for topic, stats in self.worker.admission_stats().items():
+            for key, value in stats.items():
+                yield f"actions_admission_{key}", {"topic": topic}, value
+        caches = dict(
+            self.entity_fetcher.stats(),
+            actions=self.service.actions.stats(),
+            results=self.service.results.stats(),
+        )
+        for cache, stats in caches.items():
+            for key, value in stats.items():
+                yield f"actions_cache_{key}", {"cache": cache}, value
+        yield "actions_response_partitions_owned", {}, len(self.worker.partitions.owned)
+        for kind, b in BREAKERS.items():
+            yield "actions_breaker_open", {"kind": kind}, int(b.state != "closed")
+        batch = self.jobs.last_batch
+        if batch is not None:
+            yield "actions_scheduler_batch_size", {}, batch.size
+            yield "actions_scheduler_batch_seconds", {}, batch.wall
+            yield "actions_scheduler_batch_job_p50_seconds", {}, batch.p50
+            yield "actions_scheduler_batch_job_max_seconds", {}, batch.max
 
     async def wait_for_shutdown(self):
         await self.shutdown_f
 
+    def request_shutdown(self):
+        if self.stopping is None:
+            log.info("Draining before shutdown")
+            self.stopping = asyncio.ensure_future(self.shutdown())
+
     async def shutdown(self):
         try:
+            await self.worker.drain()
             await self.jobs.stop()
             await self.worker.shutdown()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
         finally:
             self.shutdown_f.set_result(True)
@@ -0,0 +1,150 @@
+"""
+Minimal in-process metrics rendered in the Prometheus text format, served over
+HTTP on METRICS_PORT and as a reply on the METRICS_TOPIC NATS subject.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+log = logging.getLogger("metrics")
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt(labels: Labels, extra: Labels = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    inner = ",".join(f'{k}="{v}"' for k, v in items)
+    return "{" + inner + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors: List[Callable[[], Iterable[Tuple[str, Dict[str, str], float]]]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        """Register `fn` returning (name, labels, value) gauge samples at render time."""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for fn in self.collectors:
+            try:
+                for name, labels, value in fn():
+                    lines.append(f"{name}{_fmt(_labels(labels))} {value}")
+            except Exception:
+                log.exception("Metrics collector failed")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, registry: Registry = REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.values: Dict[Labels, float] = {}
+        registry.register(self)
+
+    def inc(self, n=1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_fmt(labels)} {value}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, buckets=DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.buckets = buckets
+        # labels -> [bucket counts..., sum, count]
+        self.values: Dict[Labels, List[float]] = {}
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = _labels(labels)
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def time(self, **labels):
+        """Context manager observing the wall time of its body."""
+        return _Timer(self, labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, row in self.values.items():
+            for bound, count in zip(self.buckets, row):
+                yield f"{self.name}_bucket{_fmt(labels, (('le', str(bound)),))} {count}"
+            yield f"{self.name}_bucket{_fmt(labels, (('le', '+Inf'),))} {row[-1]}"
+            yield f"{self.name}_sum{_fmt(labels)} {row[-2]}"
+            yield f"{self.name}_count{_fmt(labels)} {row[-1]}"
+
+
+async def _handle_http(reader, writer):
+    try:
+        await reader.readline()
+        body = REGISTRY.render().encode("utf-8")
+        writer.write(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + f"Content-Length: {len(body)}\r\n\r\n".encode("utf-8")
+            + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(port: int = METRICS_PORT):
+    """Serve REGISTRY on every HTTP path of `port`; disabled when port is 0."""
+    if not port:
+        return None
+    log.info(f"Serving metrics on port {port}")
+    return await asyncio.start_server(_handle_http, port=port)
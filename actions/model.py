@@ -6,6 +6,14 @@ from typing import Any, Dict, List, Optional, Union
 import orjson
 from pydantic import BaseModel, Field
 
+from .metrics import Counter
+
+DECODED_TOTAL = Counter("actions_decoded_total", "Trigger and action payloads decoded by wire format")
+
+# Bytes a JSON document can start with. As msgpack they are positive fixints,
+# which is never a valid trigger or action, so one byte decides the format.
+JSON_LEADING = frozenset(b"{[ \t\r\n")
+
 class PropertyKind(Enum):
     ENTITY = "ENTITY"
     CAS_POINTER = "CAS_POINTER"
@@ -22,6 +30,23 @@ class ActionSource(Enum):
 
 class DataFormat(Enum):
     JSON = "JSON"
+    BYTES = "BYTES"
+
+
+def wire_format(data) -> str:
+    return "json" if len(data) and data[0] in JSON_LEADING else "msgpack"
+
+
+def decode_payload(data, model: str):
+    """
+    Decode a msgpack or JSON payload with a single parse. `data` may be any
+    buffer (bytes, memoryview) and is handed to the decoder without copying.
+    """
+    fmt = wire_format(data)
+    DECODED_TOTAL.inc(model=model, format=fmt)
+    if fmt == "json":
+        return orjson.loads(data)
+    return msgpack.unpackb(data)
 
 
 def encode_enum(x):
@@ -33,26 +58,32 @@ def encode_enum(x):
         return x
 
 
-class ActionProperty(BaseModel):
-    name: str
-    kind: PropertyKind
-    data_format: DataFormat = DataFormat.JSON
-    value: Union[str, Dict, List, None, bytes]
+class EntityRef:
+    """A CFS address handed to the action service instead of the entity itself."""
+    __slots__ = ("path",)
 
-    def copy_with(self, kind=None, value=None) -> "ActionProperty":
-        return ActionProperty(
-            name=self.name,
-            data_format=self.data_format,
-            value=value if value is not None else self.value,
-            kind=kind if kind is not None else self.kind,
-        )
+    def __init__(self, path):
+        self.path = path.decode("utf-8") if isinstance(path, bytes) else path
 
-    @staticmethod
-    def many_to_bytes(items):
-        return msgpack.packb(items, default=encode_enum)
+    def to_json(self):
+        return {"$ref": self.path}
+
+
+class PropertyOps:
+    """Behaviour shared by validated ActionProperty and stored PropertyRecord."""
+    # Declared for type checking only, each subclass stores them its own way.
+    __slots__ = ()
+    name: str
+    kind: PropertyKind
+    data_format: DataFormat
+    value: Any
+    opaque: bool
 
+    @property
+    def passthrough(self) -> bool:
+        return self.opaque or self.data_format != DataFormat.JSON
 
-    def simplify(self, meta) -> Optional["ActionProperty"]:
+    def simplify(self, meta):
         if self.kind == PropertyKind.LITERAL:
             return self
         elif self.kind == PropertyKind.PATH:
@@ -70,6 +101,27 @@ class ActionProperty(BaseModel):
             return None
 
 
+class ActionProperty(PropertyOps, BaseModel):
+    name: str
+    kind: PropertyKind
+    data_format: DataFormat = DataFormat.JSON
+    value: Union[str, Dict, List, None, bytes]
+    # Opaque PATH properties are passed on as an EntityRef, never fetched.
+    opaque: bool = False
+
+    def copy_with(self, kind=None, value=None) -> "ActionProperty":
+        return ActionProperty(
+            name=self.name,
+            data_format=self.data_format,
+            value=value if value is not None else self.value,
+            kind=kind if kind is not None else self.kind,
+            opaque=self.opaque,
+        )
+
+    @staticmethod
+    def many_to_bytes(items):
+        return msgpack.packb(items, default=encode_enum)
+
 
 class Action(BaseModel):
     kind: str
@@ -78,10 +130,7 @@ class Action(BaseModel):
 
     @classmethod
     def from_bytes(cls, data: bytes) -> "Action":
-        try:
-            return cls(**msgpack.unpackb(data))
-        except:
-            return cls(**orjson.loads(data))
+        return cls(**decode_payload(data, "action"))
 
     def to_bytes(self) -> bytes:
         return msgpack.packb(self.dict(), default=encode_enum)
@@ -98,11 +147,8 @@ class ActionTrigger(BaseModel):
     jid: str = Field(default_factory=autogenerated_jid)
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> "Action":
-        try:
-            return cls(**msgpack.unpackb(data))
-        except:
-            return cls(**orjson.loads(data))
+    def from_bytes(cls, data: bytes) -> "ActionTrigger":
+        return cls(**decode_payload(data, "trigger"))
 
     def to_bytes(self) -> bytes:
         return msgpack.packb(self.dict(), default=encode_enum)
@@ -113,3 +159,110 @@ class ActionResult(BaseModel):
 
     def to_bytes(self) -> bytes:
         return msgpack.packb(self.dict(), default=encode_enum)
+
+
+# Compact storage layout for data this service wrote itself. Values are
+# msgpack arrays led by STORAGE_VERSION and decode into the slotted records
+# below without validation, which only happens at the NATS ingress.
+STORAGE_VERSION = 1
+
+
+class PropertyRecord(PropertyOps):
+    __slots__ = ("name", "kind", "data_format", "value", "opaque")
+
+    def __init__(self, name, kind, data_format, value, opaque=False):
+        self.name = name
+        self.kind = kind
+        self.data_format = data_format
+        self.value = value
+        self.opaque = opaque
+
+    def copy_with(self, kind=None, value=None) -> "PropertyRecord":
+        return PropertyRecord(
+            self.name,
+            kind if kind is not None else self.kind,
+            self.data_format,
+            value if value is not None else self.value,
+            self.opaque,
+        )
+
+
+class ActionRecord:
+    __slots__ = ("kind", "properties", "wildcard_triggers")
+
+    def __init__(self, kind, properties, wildcard_triggers):
+        self.kind = kind
+        self.properties = properties
+        self.wildcard_triggers = wildcard_triggers
+
+
+class TriggerRecord:
+    __slots__ = ("meta", "action_source", "action", "jid")
+
+    def __init__(self, meta, action_source, action, jid):
+        self.meta = meta
+        self.action_source = action_source
+        self.action = action
+        self.jid = jid
+
+
+def _property_row(p):
+    return (p.name, p.kind.value, p.data_format.value, p.value, p.opaque)
+
+
+def _property_record(row):
+    name, kind, data_format, value, opaque = row
+    return PropertyRecord(name, PropertyKind(kind), DataFormat(data_format), value, opaque)
+
+
+def _action_row(a):
+    return (a.kind, [_property_row(p) for p in a.properties], a.wildcard_triggers)
+
+
+def _action_record(row):
+    kind, properties, wildcard_triggers = row
+    return ActionRecord(kind, [_property_record(p) for p in properties], wildcard_triggers)
+
+
+def _is_stored(data) -> bool:
+    return isinstance(data, list) and len(data) == 2 and data[0] == STORAGE_VERSION
+
+
+def pack_properties(properties) -> bytes:
+    return msgpack.packb((STORAGE_VERSION, [_property_row(p) for p in properties]))
+
+
+def unpack_properties(data: bytes):
+    unpacked = msgpack.unpackb(data)
+    if _is_stored(unpacked):
+        return [_property_record(row) for row in unpacked[1]]
+    return [ActionProperty.parse_obj(x) for x in unpacked]
+
+
+def pack_action(action) -> bytes:
+    return msgpack.packb((STORAGE_VERSION, _action_row(action)))
+
+
+def unpack_action(data: bytes):
+    unpacked = msgpack.unpackb(data)
+    if _is_stored(unpacked):
+        return _action_record(unpacked[1])
+    return Action.from_bytes(data)
+
+
+def pack_trigger(trigger) -> bytes:
+    action = trigger.action if isinstance(trigger.action, str) else _action_row(trigger.action)
+    return msgpack.packb((
+        STORAGE_VERSION,
+        (trigger.meta, trigger.action_source.value, action, trigger.jid),
+    ))
+
+
+def unpack_trigger(data: bytes):
+    unpacked = msgpack.unpackb(data)
+    if not _is_stored(unpacked):
+        return ActionTrigger.from_bytes(data)
+    meta, action_source, action, jid = unpacked[1]
+    if not isinstance(action, str):
+        action = _action_record(action)
+    return TriggerRecord(meta, ActionSource(action_source), action, jid)
@@ -0,0 +1,183 @@
+"""
+Response routing by jid partition. Action responses are published to
+`conthesis.actions.responses.<partition>.<jid>` and every partition is
+subscribed by exactly one live node, chosen by rendezvous hashing over the
+members heartbeating in Redis. Nodes joining or leaving move only the
+partitions they win or lose.
+
+A node subscribes to the partitions it is about to win before it shows up as
+a member, and a leaving node keeps its partitions until the others have
+refreshed, so a response always has a subscriber while partitions move.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import socket
+import time
+import traceback
+import zlib
+from typing import Awaitable, Callable, Dict, Iterable, Set
+
+log = logging.getLogger("partitions")
+
+RESPONSE_PREFIX = "conthesis.actions.responses"
+RESPONSE_PARTITIONS = int(os.environ.get("RESPONSE_PARTITIONS", "64"))
+# With partitioning off every node subscribes to every response.
+RESPONSE_PARTITIONING = os.environ.get("RESPONSE_PARTITIONING", "1") not in ("", "0")
+
+MEMBERSHIP_INTERVAL = 5
+MEMBERSHIP_TTL = 3 * MEMBERSHIP_INTERVAL
+# Nodes leaving ask the others to refresh right away here, and wait for
+# their replies up to MEMBERSHIP_INTERVAL.
+MEMBERSHIP_TOPIC = "conthesis.actions.members"
+
+
+def partition_of(jid: str) -> int:
+    return zlib.crc32(jid.encode("utf-8")) % RESPONSE_PARTITIONS
+
+
+def response_subject(jid: str) -> str:
+    return f"{RESPONSE_PREFIX}.{partition_of(jid)}.{jid}"
+
+
+def partition_subject(partition: int) -> str:
+    # Jids may contain dots, so match any number of tokens after the partition.
+    return f"{RESPONSE_PREFIX}.{partition}.>"
+
+
+def jid_of(subject: str) -> str:
+    """The jid of a response subject, everything after the partition token."""
+    rest = subject[len(RESPONSE_PREFIX) + 1:]
+    partition, dot, jid = rest.partition(".")
+    # Old style `<prefix>.<jid>` responses only ever have the one token.
+    return jid if dot else rest
+
+
+def _weight(member: str, partition: int) -> bytes:
+    return hashlib.blake2b(f"{member}/{partition}".encode("utf-8"), digest_size=8).digest()
+
+
+def assign(members: Iterable[str], partitions: int = RESPONSE_PARTITIONS) -> Dict[int, str]:
+    """Rendezvous hashing: every partition goes to the member weighing most for it."""
+    members = sorted(members)
+    if not members:
+        return {}
+    return {p: max(members, key=lambda m: _weight(m, p)) for p in range(partitions)}
+
+
+def node_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(4)}"
+
+
+class Partitions:
+    """Keeps this node subscribed to exactly the response partitions it owns."""
+
+    def __init__(
+        self,
+        storage,
+        nc,
+        subscribe: Callable[..., Awaitable[int]],
+        unsubscribe: Callable[[int], Awaitable[None]],
+    ):
+        self.storage = storage
+        self.nc = nc
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.node = node_id()
+        self.members: Set[str] = set()
+        self.owned: Set[int] = set()
+        self.subscriptions: Dict[int, int] = {}
+        self.refreshing = asyncio.Lock()
+        self.changes = None
+        self.run = True
+        self.task = None
+
+    def owns(self, jid: str) -> bool:
+        return not RESPONSE_PARTITIONING or partition_of(jid) in self.owned
+
+    async def setup(self, queue=""):
+        if not RESPONSE_PARTITIONING:
+            await self.subscribe(f"{RESPONSE_PREFIX}.>")
+            return
+        # Responses of jobs started before responses were partitioned.
+        await self.subscribe(f"{RESPONSE_PREFIX}.*", queue=queue)
+        self.changes = await self.nc.subscribe(MEMBERSHIP_TOPIC, cb=self.handle_change)
+        await self.refresh()
+        self.task = asyncio.create_task(self.refresh_loop())
+
+    async def refresh_loop(self):
+        while self.run:
+            await asyncio.sleep(MEMBERSHIP_INTERVAL)
+            try:
+                await self.refresh()
+            except Exception:
+                traceback.print_exc()
+
+    async def handle_change(self, msg):
+        if msg.data.decode("utf-8") == self.node:
+            return
+        try:
+            await self.refresh()
+            if msg.reply:
+                await self.nc.publish(msg.reply, self.node.encode("utf-8"))
+        except Exception:
+            traceback.print_exc()
+
+    def _owned(self, members) -> Set[int]:
+        return {p for p, owner in assign(members).items() if owner == self.node}
+
+    async def refresh(self):
+        async with self.refreshing:
+            # Take on new partitions before letting go, a response is better
+            # handled twice (the job lock sorts that out) than not at all.
+            # That includes subscribing before heartbeating: once the others
+            # see this node as a member they drop what it wins.
+            now = time.time()
+            members = set(await self.storage.members(now, MEMBERSHIP_TTL)) | {self.node}
+            await self._subscribe(self._owned(members))
+            members = set(await self.storage.heartbeat(self.node, now, MEMBERSHIP_TTL))
+            owned = self._owned(members)
+            await self._subscribe(owned)
+            for p in sorted(set(self.subscriptions) - owned):
+                await self.unsubscribe(self.subscriptions.pop(p))
+            if owned != self.owned:
+                log.info(f"Node {self.node} owns {len(owned)}/{RESPONSE_PARTITIONS} response partitions")
+            self.members = members
+            self.owned = owned
+
+    async def _subscribe(self, partitions):
+        for p in sorted(partitions - set(self.subscriptions)):
+            self.subscriptions[p] = await self.subscribe(partition_subject(p))
+
+    async def stop(self):
+        """Leave the members, returning once the others have taken over our partitions."""
+        self.run = False
+        if self.task is not None:
+            self.task.cancel()
+        if not RESPONSE_PARTITIONING:
+            return
+        if self.changes is not None:
+            await self.nc.unsubscribe(self.changes)
+        await self.storage.leave(self.node)
+        peers = self.members - {self.node}
+        if not peers:
+            return
+        replied = set()
+        done = asyncio.Event()
+
+        async def on_reply(msg):
+            replied.add(msg.data.decode("utf-8"))
+            if peers <= replied:
+                done.set()
+
+        inbox = f"{MEMBERSHIP_TOPIC}.{self.node}"
+        ssid = await self.nc.subscribe(inbox, cb=on_reply)
+        try:
+            await self.nc.publish_request(MEMBERSHIP_TOPIC, inbox, self.node.encode("utf-8"))
+            await asyncio.wait_for(done.wait(), MEMBERSHIP_INTERVAL)
+        except asyncio.TimeoutError:
+            log.warning(f"Node {self.node} left without hearing from {sorted(peers - replied)}")
+        finally:
+            await self.nc.unsubscribe(ssid)
@@ -0,0 +1,153 @@
+"""
+Retry schedule and circuit breakers for dispatching jobs to action services,
+both kept per action kind.
+"""
+import collections
+import logging
+import os
+import random
+import time
+from typing import Dict
+
+from actions.config import parse_spec
+from actions.metrics import Counter
+
+log = logging.getLogger("retry")
+
+# Defaults for every action kind, overridable per kind through
+# JOB_RETRY_POLICIES="<kind>=<max_attempts>:<base>:<cap>,...".
+RETRY_MAX_ATTEMPTS = int(os.environ.get("JOB_RETRY_MAX_ATTEMPTS", "5"))
+RETRY_BASE = float(os.environ.get("JOB_RETRY_BASE", "1"))
+RETRY_CAP = float(os.environ.get("JOB_RETRY_CAP", "60"))
+
+# A breaker opens once BREAKER_MIN_CALLS outcomes seen in the last
+# BREAKER_WINDOW seconds failed at BREAKER_ERROR_RATE or more.
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", "30"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "10"))
+
+BREAKER_CHANGES = Counter("actions_breaker_changes_total", "Circuit breaker state changes by action kind")
+
+
+class RetryPolicy:
+    __slots__ = ("max_attempts", "base", "cap")
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base=RETRY_BASE, cap=RETRY_CAP):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+
+    def backoff(self, attempt: int) -> float:
+        """Seconds to wait after failed `attempt` (1-based), exponential with equal jitter."""
+        delay = min(self.cap, self.base * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+def parse_policies(spec: str) -> Dict[str, RetryPolicy]:
+    return {
+        kind: RetryPolicy(int(max_attempts or RETRY_MAX_ATTEMPTS), float(base or RETRY_BASE), float(cap or RETRY_CAP))
+        for kind, (max_attempts, base, cap) in parse_spec(spec, 3).items()
+    }
+
+
+RETRY_POLICIES = parse_policies(os.environ.get("JOB_RETRY_POLICIES", ""))
+DEFAULT_POLICY = RetryPolicy()
+
+
+def retry_policy(kind: str) -> RetryPolicy:
+    return RETRY_POLICIES.get(kind, DEFAULT_POLICY)
+
+
+class CircuitBreaker:
+    """
+    Tracks dispatch outcomes for one action kind as seen by this process.
+    While open, dispatch is refused for BREAKER_COOLDOWN. After that one probe
+    is let through per cooldown, and its outcome closes or reopens it.
+    """
+
+    def __init__(
+        self, kind, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+        error_rate=BREAKER_ERROR_RATE, cooldown=BREAKER_COOLDOWN, clock=time.monotonic,
+    ):
+        self.kind = kind
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.clock = clock
+        self.outcomes = collections.deque()
+        self.failures = 0
+        self.open_until = None
+        self.probe_at = None
+
+    @property
+    def state(self) -> str:
+        if self.open_until is None:
+            return "closed"
+        return "open" if self.clock() < self.open_until else "half_open"
+
+    def allow(self) -> bool:
+        if self.open_until is None:
+            return True
+        now = self.clock()
+        if now < self.open_until:
+            return False
+        # The probe's outcome may be observed by another replica, so allow
+        # another one once a cooldown has passed without hearing back.
+        if self.probe_at is not None and now < self.probe_at + self.cooldown:
+            return False
+        self.probe_at = now
+        return True
+
+    def retry_after(self) -> float:
+        """Seconds until allow() may let a dispatch through again."""
+        if self.open_until is None:
+            return 0.0
+        at = self.open_until
+        if self.probe_at is not None:
+            at = max(at, self.probe_at + self.cooldown)
+        return max(0.0, at - self.clock())
+
+    def record(self, ok: bool):
+        now = self.clock()
+        if self.open_until is not None:
+            # Late outcomes of dispatches made before opening are ignored.
+            if now >= self.open_until:
+                if ok:
+                    self._close()
+                else:
+                    self._open(now)
+            return
+        self.outcomes.append((now, ok))
+        if not ok:
+            self.failures += 1
+        while self.outcomes[0][0] < now - self.window:
+            _, old_ok = self.outcomes.popleft()
+            if not old_ok:
+                self.failures -= 1
+        if len(self.outcomes) >= self.min_calls and self.failures >= self.error_rate * len(self.outcomes):
+            self._open(now)
+
+    def _open(self, now):
+        log.warning(f"Opening circuit for {self.kind} for {self.cooldown}s")
+        self.open_until = now + self.cooldown
+        self.probe_at = None
+        BREAKER_CHANGES.inc(kind=self.kind, state="open")
+
+    def _close(self):
+        log.info(f"Closing circuit for {self.kind}")
+        self.open_until = None
+        self.probe_at = None
+        self.outcomes.clear()
+        self.failures = 0
+        BREAKER_CHANGES.inc(kind=self.kind, state="closed")
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def breaker(kind: str) -> CircuitBreaker:
+    if (b := BREAKERS.get(kind)) is None:
+        b = BREAKERS[kind] = CircuitBreaker(kind)
+    return b
@@ -1,38 +1,77 @@
 from typing import Any, Dict, List
 import asyncio
+import hashlib
+import os
 import orjson
 from nats.aio.client import Client as NATS
 import logging
 
 log = logging.getLogger("service")
 
-from actions.entity_fetcher import EntityFetcher
+from actions.cache import LRUCache
+from actions.config import parse_spec
+from actions.entity_fetcher import CFS_CACHE_TTL, CFS_MULTI_GET, EntityFetcher, _as_bytes, jsonize
+from actions.partitions import response_subject
 from actions.model import (
     Action,
     ActionProperty,
     ActionSource,
     ActionTrigger,
     DataFormat,
+    EntityRef,
     PropertyKind,
+    pack_properties,
 )
 
 
+ACTION_CACHE_SIZE = int(os.environ.get("ACTION_CACHE_SIZE", "1024"))
+# Max CFS fetches in flight while resolving the properties of one action.
+RESOLVE_CONCURRENCY = int(os.environ.get("RESOLVE_CONCURRENCY", "8"))
+# Frozen entities larger than this many bytes are kept once in the blob store
+# and referenced by CAS_POINTER instead of being inlined into every job.
+FREEZE_INLINE_LIMIT = int(os.environ.get("FREEZE_INLINE_LIMIT", "4096"))
+
+# Synchronous results of these action kinds are cached, per kind for the given
+# seconds: IDEMPOTENT_ACTIONS="<kind>[=<ttl>],...".
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "10"))
+
+
+def parse_idempotent(spec: str) -> Dict[str, float]:
+    return {kind: float(ttl or RESULT_CACHE_TTL) for kind, (ttl,) in parse_spec(spec, 1).items()}
+
+
+IDEMPOTENT_ACTIONS = parse_idempotent(os.environ.get("IDEMPOTENT_ACTIONS", ""))
+
+
+def _encode_default(x):
+    if isinstance(x, EntityRef):
+        return x.to_json()
+    raise TypeError
+
+
+def encode_properties(properties: Dict[str, Any]) -> bytes:
+    return orjson.dumps(properties, default=_encode_default)
+
+
 def _service_queue(kind: str) -> str:
     return f"conthesis.action.{kind}"
 
 def _response_queue(jid: str) -> str:
-    return f"conthesis.actions.responses.{jid}"
+    return response_subject(jid)
 
 
 class Service:
     def __init__(self, nc: NATS, entity_fetcher: EntityFetcher):
         self.nc = nc
         self.entity_fetcher = entity_fetcher
+        self.actions = LRUCache(ACTION_CACHE_SIZE)
+        self.results = LRUCache(RESULT_CACHE_SIZE)
 
     async def perform_action(
         self, kind: str, properties: Dict[str, Any]
     ) -> Dict[str, Any]:
-        props_json = orjson.dumps(properties)
+        props_json = encode_properties(properties)
         try:
             queue = _service_queue(kind)
             log.info(f"Attempting task {queue}")
@@ -46,16 +85,19 @@ class Service:
 
     async def perform_action_async(self, jid: str, kind: str, properties: Dict[str, Any]) -> None:
         log.info(f"Attempting to call {_service_queue(kind)}")
-        await self.nc.publish_request(_service_queue(kind), _response_queue(jid), orjson.dumps(properties))
+        await self.nc.publish_request(_service_queue(kind), _response_queue(jid), encode_properties(properties))
 
-    async def resolve_value(self, prop: ActionProperty) -> Any:
+    async def resolve_value(self, prop: ActionProperty, blobs=None) -> Any:
         if prop.kind == PropertyKind.LITERAL:
             return prop.value
+        elif prop.kind == PropertyKind.CAS_POINTER:
+            return jsonize(await self.entity_fetcher.fetch_blob(prop.value, blobs))
         elif prop.kind == PropertyKind.PATH:
-            if prop.data_format == DataFormat.JSON:
-                return await self.entity_fetcher.fetch_path_json(prop.value)
-            else:
-                return await self.entity_fetcher.fetch_path(prop.value)
+            # Frozen PATH properties point at readlink targets, which are
+            # content addressed and safe to cache indefinitely.
+            if prop.passthrough:
+                return EntityRef(prop.value)
+            return await self.entity_fetcher.fetch_path_json(prop.value, immutable=True)
         else:
             assert False, f"{prop} was not of a supported property kind"
 
@@ -66,18 +108,29 @@ class Service:
             return prop
 
     async def freeze_property(
-            self, p: ActionProperty,
+            self, p: ActionProperty, blobs=None,
     ):
         if p.kind == PropertyKind.PATH:
-            if (path := await self.entity_fetcher.readlink(p.value)) != p.value.encode("utf-8"):
-                return p.copy_with(value=path)
+            path = _as_bytes(p.value)
+            if p.passthrough:
+                # Passed on by its content address, read by the action service.
+                target = await self.entity_fetcher.readlink(path)
+                if target != path:
+                    return p.copy_with(value=target)
+                # Without one, JSON is pinned like any other entity below.
+                # Bytes cannot be inlined and stay unpinned, see compute.
+                if p.data_format != DataFormat.JSON:
+                    return p
+            # The entity comes along with the link, cached for resolve_value.
+            target, data = await self.entity_fetcher.resolve(path)
+            if target != path:
+                return p.copy_with(value=target)
             else:
-                data = None
-                if p.data_format == DataFormat.JSON:
-                    data = await self.entity.fetch_path_json(p.value)
-                else:
-                    data = await self.entity.fetch_path_json(p.value)
-                return p.copy_with(PropertyKind.LITERAL, data)
+                if blobs is not None and data is not None and len(data) > FREEZE_INLINE_LIMIT:
+                    address = hashlib.sha256(data).hexdigest()
+                    await blobs.put_blob(address, data)
+                    return p.copy_with(PropertyKind.CAS_POINTER, address)
+                return p.copy_with(PropertyKind.LITERAL, jsonize(data))
         elif p.kind == PropertyKind.LITERAL:
             return p
         else:
@@ -85,37 +138,126 @@ class Service:
 
 
     async def freeze_properties(
-            self, properties: List[ActionProperty], meta: Dict[str, Any]
+            self, properties: List[ActionProperty], meta: Dict[str, Any], blobs=None,
     ):
+        """
+        Pin properties to what they point at now. Given a `blobs` store, large
+        entities are stored there once and referenced, otherwise inlined.
+        """
         return await asyncio.gather(*[
-            self.freeze_property(p.simplify(meta))
+            self.freeze_property(p.simplify(meta), blobs)
             for p in properties
         ])
 
 
     async def resolve_properties(
-        self, properties: List[ActionProperty]
+        self, properties: List[ActionProperty], blobs=None,
     ) -> Dict[str, Any]:
-        return {p.name: await self.resolve_value(p) for p in properties}
+        def fetched(p):
+            return p.kind == PropertyKind.CAS_POINTER or (
+                p.kind == PropertyKind.PATH and not p.passthrough
+            )
+
+        paths = [p for p in properties if p.kind == PropertyKind.PATH and fetched(p)]
+        if CFS_MULTI_GET and len(paths) > 1:
+            await self.entity_fetcher.prefetch([p.value for p in paths], immutable=True)
+
+        sem = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+
+        async def resolve(p):
+            async with sem:
+                return await self.resolve_value(p, blobs)
+
+        # Identical references are resolved once and shared between properties.
+        tasks = {}
+        for p in properties:
+            key = (p.kind, p.value, p.data_format)
+            if fetched(p) and key not in tasks:
+                tasks[key] = asyncio.ensure_future(resolve(p))
+        try:
+            await asyncio.gather(*tasks.values())
+        finally:
+            for t in tasks.values():
+                t.cancel()
+
+        return {
+            p.name: tasks[(p.kind, p.value, p.data_format)].result()
+            if fetched(p)
+            else await self.resolve_value(p, blobs)
+            for p in properties
+        }
 
     async def get_action(self, trigger: ActionTrigger) -> Action:
-        if trigger.action_source == ActionSource.LITERAL and isinstance(
-            trigger.action, Action
+        # Triggers read back from job storage carry an ActionRecord, not an Action.
+        if trigger.action_source == ActionSource.LITERAL and not isinstance(
+            trigger.action, str
         ):
             return trigger.action
         elif trigger.action_source == ActionSource.PATH and isinstance(
             trigger.action, str
         ):
-            data = await self.entity_fetcher.fetch_path(trigger.action)
-            if data is None:
+            action = await self.load_action(trigger.action)
+            if action is None:
                 raise RuntimeError(f"Action {trigger.action} not found")
-            return Action.from_bytes(data)
+            return action
         else:
             raise RuntimeError("Illegal action trigger")
 
+    async def load_action(self, path: str) -> Action:
+        """
+        Fetch and validate the action at `path`, caching the parsed Action by
+        the content address the path links to.
+        """
+        path_b = path.encode("utf-8")
+        target = await self.entity_fetcher.readlink(path) or path_b
+        immutable = target != path_b
+
+        async def fetch():
+            data = await self.entity_fetcher.fetch_path(target, immutable=immutable)
+            if data is None:
+                return None
+            return Action.from_bytes(data)
+
+        return await self.actions.get_or_fetch(
+            target, fetch, ttl=None if immutable else CFS_CACHE_TTL
+        )
+
+    def invalidate_action(self, path: str) -> None:
+        """Forget where `path` links to so the next trigger follows the new target."""
+        self.entity_fetcher.invalidate(path)
+        self.actions.invalidate(path.encode("utf-8"))
+
     async def compute(self, trigger: ActionTrigger):
+        """
+        Run an action synchronously. Concurrent calls with the same kind and
+        frozen properties share one downstream call, and results of
+        IDEMPOTENT_ACTIONS are cached, unless a property could not be pinned.
+        """
         action = await self.get_action(trigger)
 
-        frozen_props = await self.freeze_properties(action.properties, trigger.meta)
-        resolved = await self.resolve_properties(frozen_props)
-        return await self.perform_action(action.kind, resolved)
+        simplified = [p.simplify(trigger.meta) for p in action.properties]
+        frozen_props = await asyncio.gather(*[self.freeze_property(p) for p in simplified])
+
+        async def perform():
+            resolved = await self.resolve_properties(frozen_props)
+            return await self.perform_action(action.kind, resolved)
+
+        # A path that froze to itself can change under us, so neither share
+        # nor cache a call reading one.
+        if any(
+            f.kind == PropertyKind.PATH and _as_bytes(f.value) == _as_bytes(p.value)
+            for p, f in zip(simplified, frozen_props)
+        ):
+            return await perform()
+
+        key = (action.kind, hashlib.sha256(pack_properties(frozen_props)).digest())
+        ttl = IDEMPOTENT_ACTIONS.get(action.kind)
+        if ttl is not None and (res := self.results.get(key)) is not None:
+            self.results.hits += 1
+            return res
+
+        res = await self.results.get_or_fetch(key, perform, ttl=0)
+        # perform_action reports a failed request as {"error": True}.
+        if ttl is not None and res is not None and res != {"error": True}:
+            self.results.put(key, res, ttl)
+        return res
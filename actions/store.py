@@ -0,0 +1,318 @@
+"""
+Backends holding job state: per job hashes, per state sets, fenced locks, the
+schedule of deadlines, blobs and node membership. Storage in actions.jobs owns
+lock bookkeeping and scheduling policy on top of one of these.
+"""
+import abc
+import logging
+import os
+from collections import namedtuple
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aredis
+
+log = logging.getLogger("store")
+
+# Selects the backend built by store_from_env: "redis" (REDIS_URL) or
+# "embedded" (in process, journaled to JOB_STORE_PATH if set).
+JOB_STORE = os.environ.get("JOB_STORE", "redis")
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH")
+
+STORAGE_EXPIRY = 6 * 60 * 60
+# Members of a state set scanned per backfill_schedule round trip.
+BACKFILL_PAGE = int(os.environ.get("JOB_BACKFILL_PAGE", "1000"))
+
+SCHEDULE_KEY = "job-schedule"
+MEMBERS_KEY = "actions-members"
+
+# One fenced flush of a job. `move` is "" (state unchanged), "add" or "move"
+# (from the `src` to the `dst` state set), `schedule` None, "rem" or a deadline.
+Write = namedtuple("Write", ["jid", "token", "fields", "move", "src", "dst", "schedule"])
+
+Lock = Tuple[str, str]
+
+
+class JobStore(abc.ABC):
+    """
+    The operations Storage needs from a backend. Batch methods take and return
+    lists in the same order, so a backend can serve them in one round trip.
+    """
+
+    @abc.abstractmethod
+    async def acquire_locks(self, jids: Sequence[str], lease_ms: int) -> List[Optional[int]]:
+        """
+        Lock each unlocked jid for `lease_ms`, bumping the `lease` field of its
+        hash and returning that as fencing token, or None where already held.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def renew_locks(self, locks: Sequence[Lock], lease_ms: int) -> List[bool]:
+        """Extend (jid, token) locks still held with that token."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def release_locks(self, locks: Sequence[Lock]) -> List[bool]:
+        """Drop (jid, token) locks still held with that token."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def write(self, writes: Sequence[Write]) -> List[bool]:
+        """
+        Apply each Write unless fenced off: another token holds the lock or a
+        newer token has written the hash already.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def hget(self, jid: str, key: str) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def hgetall(self, jids: Sequence[str]) -> List[Dict[str, bytes]]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def claim_due(self, now: float, n: int, until: float) -> List[str]:
+        """Pop up to `n` jids due at `now`, rescheduling them at `until`."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def next_deadline(self) -> Optional[float]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def backfill_schedule(self, states: Sequence[str], now: float):
+        """Schedule jobs in `states` at `now` unless already scheduled."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def put_blob(self, address: str, data: bytes):
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def get_blob(self, address: str) -> Optional[bytes]:
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def heartbeat(self, node: str, now: float, ttl: float) -> List[str]:
+        """Mark `node` alive and return every member seen within `ttl` seconds."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def members(self, now: float, ttl: float) -> List[str]:
+        """Every member seen within `ttl` seconds, without heartbeating."""
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    async def leave(self, node: str):
+        raise NotImplementedError()
+
+
+# Atomically fetch up to ARGV[2] members of the schedule due at ARGV[1] and
+# push them out to ARGV[3] so concurrent schedulers do not pick them twice.
+CLAIM_DUE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, jid in ipairs(due) do
+    redis.call('ZADD', KEYS[1], ARGV[3], jid)
+end
+return due
+"""
+
+# Take the lock unless held. The job's `lease` counter is bumped on every
+# acquisition and used as the lock token, which makes it a fencing token.
+ACQUIRE_LOCK_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return false
+end
+local fence = redis.call('HINCRBY', KEYS[2], 'lease', 1)
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+redis.call('SET', KEYS[1], fence, 'PX', ARGV[1])
+return fence
+"""
+
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Compare-and-delete, so only the holder of the token can release a lock.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Flush a job: refuse if another token holds the lock or a newer token has
+# already written, otherwise update the hash, state sets and schedule.
+# KEYS: hash, lock, src state set, dst state set, schedule
+# ARGV: token, expiry, jid, state move ("", "add", "move"), schedule ("", "rem", score), fields...
+WRITE_SCRIPT = """
+if ARGV[1] ~= '' then
+    local holder = redis.call('GET', KEYS[2])
+    if holder and holder ~= ARGV[1] then
+        return 0
+    end
+    local fence = tonumber(redis.call('HGET', KEYS[1], 'fence') or '0')
+    if tonumber(ARGV[1]) < fence then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'fence', ARGV[1])
+end
+if #ARGV > 5 then
+    redis.call('HMSET', KEYS[1], unpack(ARGV, 6))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if ARGV[4] == 'move' then
+    redis.call('SREM', KEYS[3], ARGV[3])
+end
+if ARGV[4] ~= '' then
+    redis.call('SADD', KEYS[4], ARGV[3])
+end
+if ARGV[5] == 'rem' then
+    redis.call('ZREM', KEYS[5], ARGV[3])
+elseif ARGV[5] ~= '' then
+    redis.call('ZADD', KEYS[5], ARGV[5], ARGV[3])
+end
+return 1
+"""
+
+def _str(x):
+    return x.decode("utf-8") if isinstance(x, bytes) else x
+
+
+def _decode_keys(data):
+    return {_str(k): v for k, v in data.items()}
+
+
+class RedisStore(JobStore):
+    def __init__(self, redis):
+        self.redis = redis
+        self._claim_due = redis.register_script(CLAIM_DUE_SCRIPT)
+        self._acquire_lock = redis.register_script(ACQUIRE_LOCK_SCRIPT)
+        self._renew_lock = redis.register_script(RENEW_LOCK_SCRIPT)
+        self._release_lock = redis.register_script(RELEASE_LOCK_SCRIPT)
+        self._write = redis.register_script(WRITE_SCRIPT)
+
+    def _key(self, jid):
+        return f"job-{jid}"
+
+    def _set_key(self, state):
+        return f"job-state-{state}"
+
+    def _lock_key(self, jid):
+        return f"job-lock-{jid}"
+
+    def _blob_key(self, address):
+        return f"cas-{address}"
+
+    async def _run(self, script, calls):
+        """Run `script` once per (keys, args), pipelined unless there is just one."""
+        if len(calls) == 1:
+            keys, args = calls[0]
+            return [await script.execute(keys=keys, args=args)]
+        async with await self.redis.pipeline(transaction=False) as pipe:
+            for keys, args in calls:
+                await script.execute(keys=keys, args=args, client=pipe)
+            return await pipe.execute()
+
+    async def acquire_locks(self, jids, lease_ms):
+        return await self._run(self._acquire_lock, [
+            ([self._lock_key(jid), self._key(jid)], [lease_ms, STORAGE_EXPIRY])
+            for jid in jids
+        ])
+
+    async def renew_locks(self, locks, lease_ms):
+        res = await self._run(self._renew_lock, [
+            ([self._lock_key(jid)], [token, lease_ms]) for jid, token in locks
+        ])
+        return [bool(ok) for ok in res]
+
+    async def release_locks(self, locks):
+        res = await self._run(self._release_lock, [
+            ([self._lock_key(jid)], [token]) for jid, token in locks
+        ])
+        return [bool(ok) for ok in res]
+
+    async def write(self, writes):
+        calls = []
+        for w in writes:
+            # Unused state set keys still have to be passed, point them at dst.
+            keys = [
+                self._key(w.jid),
+                self._lock_key(w.jid),
+                self._set_key(w.src or w.dst),
+                self._set_key(w.dst),
+                SCHEDULE_KEY,
+            ]
+            args = [w.token or "", STORAGE_EXPIRY, w.jid, w.move, "" if w.schedule is None else w.schedule]
+            for k, v in w.fields.items():
+                args.append(k)
+                args.append(v)
+            calls.append((keys, args))
+        return [bool(ok) for ok in await self._run(self._write, calls)]
+
+    async def hget(self, jid, key):
+        return await self.redis.hget(self._key(jid), key)
+
+    async def hgetall(self, jids):
+        if len(jids) == 1:
+            return [_decode_keys(await self.redis.hgetall(self._key(jids[0])))]
+        async with await self.redis.pipeline(transaction=False) as pipe:
+            for jid in jids:
+                await pipe.hgetall(self._key(jid))
+            res = await pipe.execute()
+        return [_decode_keys(data) for data in res]
+
+    async def claim_due(self, now, n, until):
+        due = await self._claim_due.execute(keys=[SCHEDULE_KEY], args=[now, n, until])
+        return [_str(jid) for jid in due]
+
+    async def next_deadline(self):
+        nxt = await self.redis.zrange(SCHEDULE_KEY, 0, 0, withscores=True)
+        if not nxt:
+            return None
+        return nxt[0][1]
+
+    async def backfill_schedule(self, states, now):
+        # One ZADD NX per SSCAN page rather than per job.
+        for state in states:
+            cursor = 0
+            while True:
+                cursor, jids = await self.redis.sscan(self._set_key(state), cursor=cursor, count=BACKFILL_PAGE)
+                if jids:
+                    await self.redis.zaddoption(SCHEDULE_KEY, "NX", *(x for jid in jids for x in (now, jid)))
+                if cursor == 0:
+                    break
+
+    async def put_blob(self, address, data):
+        await self.redis.set(self._blob_key(address), data, ex=STORAGE_EXPIRY)
+
+    async def get_blob(self, address):
+        return await self.redis.get(self._blob_key(address))
+
+    async def heartbeat(self, node, now, ttl):
+        async with await self.redis.pipeline(transaction=False) as pipe:
+            await pipe.zadd(MEMBERS_KEY, now, node)
+            await pipe.zremrangebyscore(MEMBERS_KEY, "-inf", now - ttl)
+            await pipe.zrange(MEMBERS_KEY, 0, -1)
+            res = await pipe.execute()
+        return [_str(m) for m in res[-1]]
+
+    async def members(self, now, ttl):
+        return [_str(m) for m in await self.redis.zrangebyscore(MEMBERS_KEY, now - ttl, "+inf")]
+
+    async def leave(self, node):
+        await self.redis.zrem(MEMBERS_KEY, node)
+
+
+def store_from_env() -> JobStore:
+    if JOB_STORE == "redis":
+        return RedisStore(aredis.StrictRedis.from_url(os.environ["REDIS_URL"]))
+    elif JOB_STORE == "embedded":
+        from actions.embedded import EmbeddedStore
+        return EmbeddedStore(JOB_STORE_PATH)
+    raise ValueError(f"Unknown JOB_STORE {JOB_STORE}")
@@ -0,0 +1,94 @@
+"""
+Runs the service as WORKER_PROCESSES forked processes, so the CPU bound parts
+of the hot path use more than one core. Every process has its own NATS
+connection in the shared queue group, its own job store client and its own
+membership in response partitioning.
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+import traceback
+
+from actions.main import main
+from actions.store import JOB_STORE
+
+log = logging.getLogger("supervisor")
+
+# Number of worker processes, 0 for one per core.
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "1"))
+# Pause before replacing a process that exited on its own.
+WORKER_RESTART_DELAY = float(os.environ.get("WORKER_RESTART_DELAY", "1"))
+
+
+def worker_count() -> int:
+    n = WORKER_PROCESSES or os.cpu_count() or 1
+    if n > 1 and JOB_STORE == "embedded":
+        log.warning("The embedded job store lives in one process, running a single worker")
+        return 1
+    return n
+
+
+def run_worker(index=0):
+    asyncio.run(main(index))
+
+
+class Supervisor:
+    """Forks the workers, replaces ones that die and forwards SIGTERM/SIGINT."""
+
+    def __init__(self, n):
+        self.n = n
+        self.children = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                run_worker(index)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        log.info(f"Started worker {index} as pid {pid}")
+        self.children[pid] = index
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.n):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None or self.stopping:
+                continue
+            log.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting")
+            time.sleep(WORKER_RESTART_DELAY)
+            if not self.stopping:
+                self.spawn(index)
+        log.info("All workers stopped")
+
+
+def run():
+    n = worker_count()
+    if n == 1:
+        run_worker()
+    else:
+        Supervisor(n).run()
@@ -1,19 +1,30 @@
-import time
 import asyncio
 import os
 import traceback
 import logging
+from typing import Dict, List
 
 import orjson
 from nats.aio.client import Client as NATS
 
-from actions.model import ActionTrigger
+from actions import metrics
+from actions.admission import PENDING_BYTES_LIMIT, PENDING_MSGS_LIMIT, Admission
+from actions.model import ActionTrigger, decode_payload
+from actions.partitions import RESPONSE_PREFIX, Partitions, jid_of
 from actions.service import Service
 from actions.jobs import JobsManager
 
 ASYNC_TOPIC = "conthesis.action.TriggerAsyncAction"
-RESPONSE_TOPICS = "conthesis.actions.responses.>"
+ASYNC_BATCH_TOPIC = "conthesis.action.TriggerAsyncActionBatch"
+RESPONSE_TOPICS = f"{RESPONSE_PREFIX}.>"
 TOPIC = "conthesis.action.TriggerAction"
+INVALIDATE_TOPIC = "conthesis.actions.invalidate"
+METRICS_TOPIC = "conthesis.actions.metrics"
+
+OVERLOADED = orjson.dumps({"error": "overloaded"})
+
+# Replicas share trigger traffic through this NATS queue group.
+QUEUE_GROUP = os.environ.get("NATS_QUEUE_GROUP", "conthesis-actions")
 
 log = logging.getLogger("worker")
 
@@ -26,12 +37,53 @@ class Worker:
         self.nc = nc
         self.svc = svc
         self.jobs = jobs
+        self.admissions: Dict[str, Admission] = {}
+        self.subscriptions: Dict[str, List[int]] = {}
+        self.partitions = Partitions(jobs.storage, nc, self.subscribe_responses, self.unsubscribe_responses)
+        jobs.storage.affinity = self.partitions.owns
 
     async def setup(self):
         await self.nc.connect(os.environ["NATS_URL"], loop=asyncio.get_event_loop())
-        await self.nc.subscribe(TOPIC, cb=self.handle)
-        await self.nc.subscribe(ASYNC_TOPIC, cb=self.handle_async_job)
-        await self.nc.subscribe(RESPONSE_TOPICS, cb=self.handle_action_response)
+        await self.subscribe(TOPIC, self.handle, on_shed=self.reply_overloaded, queue=QUEUE_GROUP)
+        await self.subscribe(ASYNC_TOPIC, self.handle_async_job, on_shed=self.reply_overloaded, queue=QUEUE_GROUP)
+        await self.subscribe(ASYNC_BATCH_TOPIC, self.handle_async_batch, on_shed=self.reply_overloaded, queue=QUEUE_GROUP)
+        await self.partitions.setup(queue=QUEUE_GROUP)
+        await self.nc.subscribe(INVALIDATE_TOPIC, cb=self.handle_invalidate)
+        await self.nc.subscribe(METRICS_TOPIC, cb=self.handle_metrics)
+
+    async def subscribe(self, topic, cb, on_shed=None, queue="", subject=None, shed=True):
+        """Subscribe `subject` (default `topic`) through the admission control of `topic`."""
+        admission = self.admissions.get(topic)
+        if admission is None:
+            admission = self.admissions[topic] = Admission(topic, cb, on_shed=on_shed, shed=shed)
+        ssid = await self.nc.subscribe(
+            subject or topic,
+            queue=queue,
+            cb=admission.admit,
+            pending_msgs_limit=PENDING_MSGS_LIMIT,
+            pending_bytes_limit=PENDING_BYTES_LIMIT,
+        )
+        self.subscriptions.setdefault(topic, []).append(ssid)
+        return ssid
+
+    async def subscribe_responses(self, subject, queue=""):
+        # Responses are never shed. A dropped one would time its job out and
+        # count against the action's retries and circuit breaker, though the
+        # action itself was fine. Their number is bounded by the jobs running.
+        return await self.subscribe(
+            RESPONSE_TOPICS, self.handle_action_response, queue=queue, subject=subject, shed=False,
+        )
+
+    async def unsubscribe_responses(self, ssid):
+        await self.nc.unsubscribe(ssid)
+        self.subscriptions[RESPONSE_TOPICS].remove(ssid)
+
+    def admission_stats(self):
+        """In-flight, queued and shed counts per topic."""
+        return {topic: admission.stats() for topic, admission in self.admissions.items()}
+
+    async def reply_overloaded(self, msg):
+        await self.reply(msg, OVERLOADED, json=False)
 
     async def reply(self, msg, data, json=True):
         reply = msg.reply
@@ -43,7 +95,6 @@ class Worker:
             log.error("NATS message reply-to was unset and we were unable to reply")
 
     async def handle_async_job(self, msg):
-        start = time.monotonic()
         trigger = None
         try:
             trigger = ActionTrigger.from_bytes(msg.data)
@@ -57,19 +108,56 @@ class Worker:
             traceback.print_exc()
             return
 
-        end = time.monotonic()
+    async def handle_async_batch(self, msg):
+        """
+        Register a msgpack (or JSON) array of triggers and reply with a JSON
+        list of {"jid", "status"} in the same order. Triggers that fail to
+        parse are reported as "invalid" with a null jid, repeats of a jid
+        earlier in the batch as "duplicate".
+        """
+        try:
+            items = decode_payload(msg.data, "batch")
+        except Exception:
+            traceback.print_exc()
+            return
+
+        triggers = []
+        for item in items:
+            try:
+                triggers.append(ActionTrigger(**item))
+            except Exception:
+                traceback.print_exc()
+                triggers.append(None)
 
-        delta = end - start
+        try:
+            acks = iter(await self.jobs.register_many([t for t in triggers if t is not None]))
+        except Exception:
+            traceback.print_exc()
+            return
+
+        await self.reply(msg, [
+            {"jid": None, "status": "invalid"} if t is None
+            else {"jid": t.jid, "status": next(acks)}
+            for t in triggers
+        ])
 
     async def handle_action_response(self, msg):
         try:
-            jid = msg.subject[len(RESPONSE_TOPICS) - 1 : ]
+            jid = jid_of(msg.subject)
             log.info(f"Resuming job {jid}")
             await self.jobs.resume(jid, orjson.loads(msg.data))
         except:
             traceback.print_exc()
 
 
+    async def handle_metrics(self, msg):
+        await self.reply(msg, metrics.REGISTRY.render().encode("utf-8"), json=False)
+
+    async def handle_invalidate(self, msg):
+        path = msg.data.decode("utf-8")
+        log.info(f"Invalidating action {path}")
+        self.svc.invalidate_action(path)
+
     async def handle(self, msg):
         trigger = None
         try:
@@ -85,5 +173,19 @@ class Worker:
         except Exception:
             traceback.print_exc()
 
-    async def shutdown():
+    async def drain(self):
+        """
+        Stop taking messages and wait for the handlers of the ones already
+        taken. Response partitions are handed to the remaining nodes first.
+        """
+        await self.partitions.stop()
+        drains = []
+        for ssids in self.subscriptions.values():
+            for ssid in ssids:
+                drains.append(await self.nc.drain(ssid))
+        self.subscriptions = {}
+        await asyncio.gather(*drains, return_exceptions=True)
+        await asyncio.gather(*[a.drain() for a in self.admissions.values()])
+
+    async def shutdown(self):
         await self.nc.drain()
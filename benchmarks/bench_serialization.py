@@ -0,0 +1,78 @@
+"""
+Compare the pydantic round trip job storage used to do for trigger, action
+and variables against the compact versioned records in actions.model.
+
+    python -m benchmarks.bench_serialization
+"""
+import time
+
+import msgpack
+
+from actions.model import (
+    Action,
+    ActionProperty,
+    ActionTrigger,
+    pack_action,
+    pack_properties,
+    pack_trigger,
+    unpack_action,
+    unpack_properties,
+    unpack_trigger,
+)
+
+N = 5000
+SIZES = (4, 16, 64)
+
+
+def make_trigger(n):
+    kinds = ["META_FIELD", "ENTITY", "PATH", "LITERAL"]
+    properties = []
+    for i in range(n):
+        kind = kinds[i % len(kinds)]
+        if kind == "LITERAL":
+            value = {"threshold": i, "labels": [f"l{j}" for j in range(4)]}
+        elif kind == "PATH":
+            value = f"/entity/{'ab' * 16}/{i}"
+        else:
+            value = f"field{i}"
+        properties.append({"name": f"p{i}", "kind": kind, "value": value})
+    return ActionTrigger(
+        meta={"entity": "ab" * 32, "field0": "x", "source": "bench"},
+        action_source="LITERAL",
+        action={"kind": "bench", "properties": properties},
+    )
+
+
+def old_round_trip(trigger):
+    t = ActionTrigger.from_bytes(trigger.to_bytes())
+    a = Action.from_bytes(t.action.to_bytes())
+    [ActionProperty.parse_obj(x) for x in msgpack.unpackb(ActionProperty.many_to_bytes(a.properties))]
+
+
+def new_round_trip(trigger):
+    t = unpack_trigger(pack_trigger(trigger))
+    a = unpack_action(pack_action(t.action))
+    unpack_properties(pack_properties(a.properties))
+
+
+def bench(label, fn, trigger):
+    start = time.perf_counter()
+    for _ in range(N):
+        fn(trigger)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1e6 / N:8.2f} us/job")
+    return elapsed
+
+
+def main():
+    print(f"{N} trigger+action+variables round trips per run")
+    for n in SIZES:
+        trigger = make_trigger(n)
+        print(f"-- {n} properties, {len(trigger.to_bytes())} -> {len(pack_trigger(trigger))} bytes")
+        old = bench("pydantic", old_round_trip, trigger)
+        new = bench("compact records", new_round_trip, trigger)
+        print(f"speedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
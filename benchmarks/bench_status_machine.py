@@ -0,0 +1,73 @@
+"""
+Compare building a per-job transitions.AsyncMachine against the shared
+STATUS_TRANSITIONS table used by Job.
+
+    python -m benchmarks.bench_status_machine
+"""
+import asyncio
+import time
+
+from transitions.extensions.asyncio import AsyncMachine
+
+from actions.jobs import STATUS_EVENTS, Job, Status
+
+N = 20000
+
+
+class MachineModel:
+    async def load_data(self):
+        pass
+
+    async def start_run(self):
+        pass
+
+
+class TableModel(Job):
+    def __init__(self, initial):
+        self.state = initial
+
+    async def load_data(self):
+        pass
+
+    async def start_run(self):
+        pass
+
+
+def old_path():
+    model = MachineModel()
+    AsyncMachine(model, states=Status, transitions=STATUS_EVENTS, initial=Status.PENDING, ignore_invalid_triggers=True)
+    return model
+
+
+def new_path():
+    return TableModel(Status.PENDING)
+
+
+async def run_to_running(make):
+    for _ in range(N):
+        model = make()
+        await model.proceed()
+        await model.proceed()
+        await model.succeeded()
+
+
+def bench(label, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed * 1e6 / N:8.2f} us/job")
+    return elapsed
+
+
+def main():
+    print(f"{N} jobs per run")
+    old = bench("construct AsyncMachine", lambda: [old_path() for _ in range(N)])
+    new = bench("construct table Job", lambda: [new_path() for _ in range(N)])
+    print(f"construction speedup: {old / new:.1f}x")
+    old = bench("construct+transition AsyncMachine", lambda: asyncio.run(run_to_running(old_path)))
+    new = bench("construct+transition table Job", lambda: asyncio.run(run_to_running(new_path)))
+    print(f"end to end speedup: {old / new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Drive Worker end to end against in-process fakes of NATS, Redis, CFS and an
+action service, and report throughput, job latency and Redis cost per job.
+
+    python -m benchmarks.bench_worker --jobs 2000 --path-ratio 0.5 --properties 4
+    python -m benchmarks.bench_worker --store embedded --journal /tmp/jobs.journal
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+
+import orjson
+
+from actions.entity_fetcher import EntityFetcher
+from actions.jobs import JobsManager, Storage
+from actions.embedded import EmbeddedStore
+from actions.store import RedisStore
+from actions.model import Action, ActionProperty, ActionSource, ActionTrigger, PropertyKind
+from actions.service import Service
+from actions.worker import ASYNC_TOPIC, Worker
+from benchmarks.fakes import FakeActionService, FakeCFS, FakeNATS, FakeRedis
+
+KIND = "bench"
+
+
+class BenchEmbeddedStore(EmbeddedStore):
+    """Embedded store reporting job writes like RedisData.on_hmset."""
+
+    def __init__(self, on_hmset, path=None):
+        self.on_hmset = on_hmset
+        super().__init__(path)
+
+    def _log(self, record):
+        # Live writes only, records replayed from --journal are not this run's.
+        super()._log(record)
+        if record[0] == "w":
+            self.on_hmset(f"job-{record[1]}", record[2])
+
+
+def make_action(n_properties, path_property_ratio, n_entities):
+    properties = []
+    for i in range(n_properties):
+        if random.random() < path_property_ratio:
+            properties.append(ActionProperty(
+                name=f"p{i}", kind=PropertyKind.ENTITY, value=f"e{random.randrange(n_entities)}",
+            ))
+        else:
+            properties.append(ActionProperty(name=f"p{i}", kind=PropertyKind.LITERAL, value=f"v{i}"))
+    return Action(kind=KIND, properties=properties)
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        os.environ.setdefault("NATS_URL", "nats://fake")
+        os.environ.setdefault("REDIS_URL", "redis://fake")
+        self.nc = FakeNATS()
+        self.redis = FakeRedis(latency=args.redis_delay)
+        self.cfs = FakeCFS(self.nc, delay=args.cfs_delay)
+        self.action_service = FakeActionService(
+            self.nc, KIND, delay=args.action_delay, failure_rate=args.failure_rate,
+        )
+        self.service = Service(self.nc, EntityFetcher(self.nc, resolve_get=args.cfs_resolve))
+        self.jobs = JobsManager(self.service)
+        if args.store == "embedded":
+            store = BenchEmbeddedStore(self.on_hmset, args.journal)
+        else:
+            store = RedisStore(self.redis)
+        self.jobs.storage = Storage(store, on_schedule=self.jobs._on_schedule)
+        self.worker = Worker(self.nc, self.service, self.jobs)
+        self.started = {}
+        self.last_done = None
+        self.latencies = []
+        self.done = asyncio.Event()
+        self.redis.store.on_hmset = self.on_hmset
+
+    def on_hmset(self, key, mapping):
+        if mapping.get("state") != "SUCCESS":
+            return
+        jid = key[len("job-"):]
+        start = self.started.pop(jid, None)
+        if start is not None:
+            self.last_done = time.perf_counter()
+            self.latencies.append(self.last_done - start)
+            if not self.started:
+                self.done.set()
+
+    async def setup(self):
+        args = self.args
+        for i in range(args.entities):
+            self.cfs.put(f"/cas/e{i}", orjson.dumps({"entity": i, "pad": "x" * args.entity_size}))
+            self.cfs.link(f"/entity/e{i}", f"/cas/e{i}")
+        for i in range(args.actions):
+            action = make_action(args.properties, args.path_property_ratio, args.entities)
+            self.cfs.put(f"/cas/action{i}", action.to_bytes())
+            self.cfs.link(f"/actions/a{i}", f"/cas/action{i}")
+        await self.cfs.setup()
+        await self.action_service.setup()
+        await self.worker.setup()
+        await self.jobs.setup()
+
+    def make_trigger(self):
+        args = self.args
+        if random.random() < args.path_ratio:
+            return ActionTrigger(
+                action_source=ActionSource.PATH,
+                action=f"/actions/a{random.randrange(args.actions)}",
+            )
+        return ActionTrigger(
+            action_source=ActionSource.LITERAL,
+            action=make_action(args.properties, args.path_property_ratio, args.entities),
+        )
+
+    async def run(self):
+        args = self.args
+        await self.setup()
+        triggers = [self.make_trigger() for _ in range(args.jobs)]
+        start = time.perf_counter()
+        for trigger in triggers:
+            self.started[trigger.jid] = time.perf_counter()
+            await self.nc.publish_request(ASYNC_TOPIC, "_INBOX.bench", trigger.to_bytes())
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        try:
+            await asyncio.wait_for(self.done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = (self.last_done or time.perf_counter()) - start
+        await self.worker.drain()
+        await self.jobs.stop()
+        return elapsed
+
+    def report(self, elapsed):
+        lat = sorted(self.latencies)
+        done = len(lat)
+
+        def pct(p):
+            return lat[min(done - 1, int(p * done))] * 1000 if done else float("nan")
+
+        print(f"jobs completed      {done}/{self.args.jobs} ({len(self.started)} unfinished)")
+        print(f"throughput          {done / elapsed:.0f} jobs/s")
+        print(f"latency p50/p99     {pct(0.5):.2f} / {pct(0.99):.2f} ms")
+        if self.args.store == "redis":
+            print(f"redis round trips   {self.redis.round_trips / max(done, 1):.1f} per job")
+            print(f"redis commands      {self.redis.commands / max(done, 1):.1f} per job")
+        print(f"cfs requests        {self.cfs.requests / max(done, 1):.2f} per job")
+        print(f"actions dropped     {self.action_service.dropped}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="triggers per second, 0 for a single burst")
+    parser.add_argument("--path-ratio", type=float, default=0.5, help="fraction of PATH (vs LITERAL) actions")
+    parser.add_argument("--actions", type=int, default=20, help="distinct PATH action definitions")
+    parser.add_argument("--properties", type=int, default=4)
+    parser.add_argument("--path-property-ratio", type=float, default=0.5)
+    parser.add_argument("--entities", type=int, default=100)
+    parser.add_argument("--entity-size", type=int, default=256)
+    parser.add_argument("--cfs-delay", type=float, default=0.0)
+    parser.add_argument("--action-delay", type=float, default=0.001)
+    parser.add_argument("--redis-delay", type=float, default=0.0, help="seconds per Redis round trip")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of action calls never answered")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cfs-resolve", action="store_true", help="freeze through the combined readlink+get request")
+    parser.add_argument("--store", choices=["redis", "embedded"], default="redis", help="job store backend")
+    parser.add_argument("--journal", default=None, help="journal file for --store embedded")
+    return parser.parse_args(argv)
+
+
+async def run(args):
+    random.seed(args.seed)
+    bench = Bench(args)
+    elapsed = await bench.run()
+    bench.report(elapsed)
+    return bench
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
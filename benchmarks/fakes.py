@@ -0,0 +1,305 @@
+"""
+In-process stand-ins for the NATS client, Redis (fakeredis, with lupa for its
+Lua scripts) and the CFS / action services, so Worker can be driven without
+any servers.
+"""
+import asyncio
+import itertools
+import random
+from typing import Any, Callable, Dict, List, Optional
+
+import fakeredis
+import msgpack
+import orjson
+
+from actions.store import WRITE_SCRIPT
+
+
+class Msg:
+    __slots__ = ("subject", "reply", "data")
+
+    def __init__(self, subject, reply, data):
+        self.subject = subject
+        self.reply = reply
+        self.data = data
+
+
+class _Sub:
+    def __init__(self, subject, queue, cb):
+        self.subject = subject
+        self.queue = queue
+        self.cb = cb
+        self.pending_queue = None
+
+
+def subject_matches(pattern: str, subject: str) -> bool:
+    p = pattern.split(".")
+    s = subject.split(".")
+    for i, token in enumerate(p):
+        if token == ">":
+            return len(s) > i
+        if i >= len(s) or (token != "*" and token != s[i]):
+            return False
+    return len(p) == len(s)
+
+
+class FakeNATS:
+    """Delivers every publish to matching subscriptions as a new task."""
+
+    def __init__(self):
+        self._subs: Dict[int, _Sub] = {}
+        self._ssid = itertools.count(1)
+        self._inbox = itertools.count(1)
+        self.published = 0
+
+    async def connect(self, *args, **kwargs):
+        pass
+
+    async def drain(self, sid=None):
+        if sid is None:
+            self._subs.clear()
+            return None
+        self._subs.pop(sid, None)
+        return asyncio.ensure_future(asyncio.sleep(0))
+
+    async def subscribe(self, subject, queue="", cb=None, **kwargs):
+        ssid = next(self._ssid)
+        self._subs[ssid] = _Sub(subject, queue, cb)
+        return ssid
+
+    async def unsubscribe(self, ssid, max_msgs=0):
+        self._subs.pop(ssid, None)
+
+    def _deliver(self, subject, reply, data):
+        self.published += 1
+        groups = {}
+        for sub in list(self._subs.values()):
+            if not subject_matches(sub.subject, subject):
+                continue
+            if sub.queue:
+                groups.setdefault(sub.queue, []).append(sub)
+            else:
+                asyncio.ensure_future(sub.cb(Msg(subject, reply, data)))
+        for members in groups.values():
+            asyncio.ensure_future(random.choice(members).cb(Msg(subject, reply, data)))
+
+    async def publish(self, subject, payload):
+        self._deliver(subject, "", payload)
+
+    async def publish_request(self, subject, reply, payload):
+        self._deliver(subject, reply, payload)
+
+    async def request(self, subject, payload, timeout=0.5, **kwargs):
+        inbox = f"_INBOX.{next(self._inbox)}"
+        fut = asyncio.get_running_loop().create_future()
+
+        async def on_reply(msg):
+            if not fut.done():
+                fut.set_result(msg)
+
+        ssid = await self.subscribe(inbox, cb=on_reply)
+        try:
+            self._deliver(subject, inbox, payload)
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            await self.unsubscribe(ssid)
+
+
+def _b(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return str(value).encode("utf-8")
+
+
+def _pairs(args) -> Dict[Any, float]:
+    """aredis style score, member, ... arguments as a redis-py mapping."""
+    return {member: float(score) for score, member in zip(args[::2], args[1::2])}
+
+
+class RedisData:
+    """
+    A fakeredis server behind the aredis style calls actions.store makes. The
+    Lua scripts of actions.store run as they are, through fakeredis' Lua
+    support, so the fake cannot drift from them.
+    """
+
+    def __init__(self):
+        self.redis = fakeredis.FakeStrictRedis(server=fakeredis.FakeServer())
+        self.commands = 0
+        self.on_hmset: Optional[Callable[[str, Dict], None]] = None
+
+    async def zadd(self, name, *args):
+        return self.redis.zadd(name, _pairs(args))
+
+    async def zaddoption(self, name, option=None, *args):
+        return self.redis.zadd(name, _pairs(args), nx="NX" in option, xx="XX" in option)
+
+    def script(self, script, keys, args):
+        res = self.redis.eval(script, len(keys), *keys, *args)
+        if script == WRITE_SCRIPT and res and self.on_hmset is not None:
+            fields = args[5:]
+            self.on_hmset(keys[0], dict(zip(fields[::2], fields[1::2])))
+        return res
+
+    def __getattr__(self, name):
+        fn = getattr(self.redis, name)
+
+        async def command(*args, **kwargs):
+            return fn(*args, **kwargs)
+
+        return command
+
+
+class FakePipeline:
+    """Queues commands and runs them back to back on execute: one round trip."""
+
+    def __init__(self, redis: "FakeRedis"):
+        self.redis = redis
+        self.ops: List = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.ops = []
+
+    def __getattr__(self, name):
+        fn = getattr(self.redis.store, name)
+
+        async def queue(*args, **kwargs):
+            self.ops.append((fn, args, kwargs))
+
+        return queue
+
+    async def execute(self):
+        await self.redis.round_trip()
+        ops, self.ops = self.ops, []
+        res = []
+        for fn, args, kwargs in ops:
+            self.redis.store.commands += 1
+            res.append(await fn(*args, **kwargs))
+        return res
+
+
+class FakeScript:
+    def __init__(self, redis: "FakeRedis", script):
+        self.redis = redis
+        self.script = script
+
+    async def execute(self, keys=[], args=[], client=None):
+        if isinstance(client, FakePipeline):
+            async def run():
+                return self.redis.store.script(self.script, keys, args)
+            client.ops.append((run, (), {}))
+            return None
+        await self.redis.round_trip()
+        self.redis.store.commands += 1
+        return self.redis.store.script(self.script, keys, args)
+
+
+class FakeRedis:
+    """
+    Client facade over RedisData shaped like aredis.StrictRedis. Each direct
+    command and each pipeline execute counts as one round trip, taking
+    `latency` seconds.
+    """
+
+    def __init__(self, store: Optional[RedisData] = None, latency: float = 0.0):
+        self.store = store or RedisData()
+        self.latency = latency
+        self.round_trips = 0
+
+    @property
+    def commands(self):
+        return self.store.commands
+
+    async def round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def pipeline(self, transaction=True, shard_hint=None):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        return FakeScript(self, script)
+
+    def __getattr__(self, name):
+        fn = getattr(self.store, name)
+
+        async def command(*args, **kwargs):
+            await self.round_trip()
+            self.store.commands += 1
+            return await fn(*args, **kwargs)
+
+        return command
+
+
+class FakeCFS:
+    """Answers conthesis.cfs.get / readlink from in-memory dicts."""
+
+    def __init__(self, nc: FakeNATS, delay: float = 0.0):
+        self.nc = nc
+        self.delay = delay
+        self.entities: Dict[bytes, bytes] = {}
+        self.links: Dict[bytes, bytes] = {}
+        self.requests = 0
+
+    def put(self, path: str, data: bytes):
+        self.entities[_b(path)] = data
+
+    def link(self, path: str, target: str):
+        self.links[_b(path)] = _b(target)
+
+    async def setup(self):
+        await self.nc.subscribe("conthesis.cfs.get", cb=self.handle_get)
+        await self.nc.subscribe("conthesis.cfs.readlink", cb=self.handle_readlink)
+        await self.nc.subscribe("conthesis.cfs.resolve", cb=self.handle_resolve)
+
+    async def handle_get(self, msg):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        await self.nc.publish(msg.reply, self.entities.get(msg.data, b""))
+
+    async def handle_readlink(self, msg):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        await self.nc.publish(msg.reply, self.links.get(msg.data, msg.data))
+
+    async def handle_resolve(self, msg):
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        target = self.links.get(msg.data, msg.data)
+        await self.nc.publish(msg.reply, msgpack.packb([target, self.entities.get(target)]))
+
+
+class FakeActionService:
+    """
+    Serves conthesis.action.<kind>. Replies after `delay` seconds, except for
+    a `failure_rate` fraction of requests which are never answered.
+    """
+
+    def __init__(self, nc: FakeNATS, kind: str, delay: float = 0.0, failure_rate: float = 0.0):
+        self.nc = nc
+        self.kind = kind
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.dropped = 0
+
+    async def setup(self):
+        await self.nc.subscribe(f"conthesis.action.{self.kind}", cb=self.handle)
+
+    async def handle(self, msg):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if random.random() < self.failure_rate:
+            self.dropped += 1
+            return
+        await self.nc.publish(msg.reply, orjson.dumps({"ok": True}))
@@ -0,0 +1,33 @@
+import asyncio
+
+from actions.admission import MAX_INFLIGHT, MAX_QUEUED, Admission, parse_limits
+
+
+def test_sheds_past_the_queue_limit_unless_told_not_to():
+    async def run(shed):
+        release = asyncio.Event()
+        handled, shed_msgs = [], []
+
+        async def handle(msg):
+            await release.wait()
+            handled.append(msg)
+
+        async def on_shed(msg):
+            shed_msgs.append(msg)
+
+        admission = Admission("topic", handle, on_shed=on_shed, shed=shed)
+        admission.max_queued = 1
+        admission.sem = asyncio.Semaphore(1)
+        for i in range(3):
+            await admission.admit(i)
+            await asyncio.sleep(0)
+        release.set()
+        await admission.drain()
+        return sorted(handled), shed_msgs
+
+    assert asyncio.run(run(True)) == ([0, 1], [2])
+    assert asyncio.run(run(False)) == ([0, 1, 2], [])
+
+
+def test_parse_limits():
+    assert parse_limits("hot=4:16, topic") == {"hot": (4, 16), "topic": (MAX_INFLIGHT, MAX_QUEUED)}
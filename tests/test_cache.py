@@ -0,0 +1,55 @@
+import asyncio
+
+from actions.cache import LRUCache
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_ttl_expiry():
+    cache = LRUCache(2, ttl=-1)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+    cache.put("b", 2, ttl=None)
+    assert cache.get("b") == 2
+
+
+def test_byte_budget_evicts_and_skips_large_values():
+    cache = LRUCache(10, maxbytes=8)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    cache.put("c", b"12")
+    assert cache.get("a") is None
+    assert cache.bytes == 6
+    cache.put("b", b"123456789")
+    assert cache.get("b") is None
+    assert cache.get("c") == b"12"
+    assert cache.bytes == 2
+
+
+def test_concurrent_fetches_are_coalesced():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return b"data"
+
+    async def run():
+        cache = LRUCache(10)
+        res = await asyncio.gather(*[cache.get_or_fetch("k", fetch) for _ in range(5)])
+        assert res == [b"data"] * 5
+        assert await cache.get_or_fetch("k", fetch) == b"data"
+        return cache
+
+    cache = asyncio.run(run())
+    assert len(calls) == 1
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "coalesced": 4}
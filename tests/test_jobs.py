@@ -0,0 +1,204 @@
+import asyncio
+
+from transitions.extensions.asyncio import AsyncMachine
+
+from actions.jobs import STATUS_EVENTS, Job, Status
+
+
+class Recorder:
+    def __init__(self):
+        self.calls = []
+
+    async def load_data(self, *args):
+        self.calls.append(("load_data", self.state))
+
+    async def start_run(self, *args):
+        self.calls.append(("start_run", self.state))
+
+    async def schedule_retry(self, *args):
+        self.calls.append(("schedule_retry", self.state))
+
+    async def checkpoint(self, *args):
+        self.calls.append(("checkpoint", self.state))
+
+
+class TableJob(Recorder, Job):
+    def __init__(self, initial):
+        Recorder.__init__(self)
+        self.state = initial
+
+
+def machine_job(initial):
+    model = Recorder()
+    AsyncMachine(model, states=Status, transitions=STATUS_EVENTS, initial=initial, ignore_invalid_triggers=True)
+    return model
+
+
+def test_table_matches_async_machine():
+    async def run():
+        for trigger in ["proceed", "suspend", "succeeded", "expired", "error", "revoke"]:
+            for state in Status:
+                old = machine_job(state)
+                new = TableJob(state)
+                old_res = await getattr(old, trigger)("data")
+                new_res = await getattr(new, trigger)("data")
+                assert (old_res, old.state, old.calls) == (new_res, new.state, new.calls), (trigger, state)
+
+    asyncio.run(run())
+
+
+def test_failing_before_keeps_state():
+    class Failing(TableJob):
+        async def load_data(self):
+            raise RuntimeError()
+
+    async def run():
+        job = Failing(Status.PENDING)
+        try:
+            await job.proceed()
+        except RuntimeError:
+            pass
+        assert job.state is Status.PENDING
+
+    asyncio.run(run())
+
+
+def test_suspend_checkpoints_deltas_and_heartbeats(monkeypatch):
+    from actions import jobs
+    from actions.embedded import EmbeddedStore
+    from actions.jobs import JidStorage, Storage
+
+    monkeypatch.setattr(jobs, "CHECKPOINT_DELTAS", 2)
+
+    async def run():
+        storage = Storage(EmbeddedStore())
+        jid_storage = JidStorage("jid", storage)
+        await jid_storage.load()
+        job = Job("jid", jid_storage, None, Status.RUNNING)
+        await jid_storage.set_timestamp(0)
+        for result, data in [
+            jobs.response_result({"$suspend": {"done": 1, "cursor": "a"}}),
+            jobs.response_result({"$suspend": {"done": 2}}),
+            jobs.response_result({"$suspend": {"cursor": None, "parts": {"x": 1}}}),
+        ]:
+            assert result == "suspend"
+            assert await job.suspend(data)
+        assert job.state is Status.RUNNING
+        assert not await job.has_timed_out()
+        assert await jid_storage.get_checkpoint_deltas() == 0
+        assert await jid_storage.get_checkpoint() == {"done": 2, "parts": {"x": 1}}
+        await job.suspend({"parts": {"y": 2}})
+        assert await jid_storage.get("checkpoint-1") is not None
+        assert await jid_storage.get_checkpoint() == {"done": 2, "parts": {"x": 1, "y": 2}}
+
+    asyncio.run(run())
+
+
+def test_local_sessions_queue_and_keep_their_token(monkeypatch):
+    from actions import jobs
+    from actions.jobs import Storage
+    from actions.store import RedisStore
+    from benchmarks.fakes import FakeRedis
+
+    monkeypatch.setattr(jobs, "JOB_OWNERSHIP_SIZE", 0)
+
+    async def run():
+        redis = FakeRedis()
+        storage = Storage(RedisStore(redis))
+        assert await storage.enter_session("jid")
+        assert not await storage.enter_session("jid", blocking=False)
+        lock = await storage.lock("jid")
+        assert await lock.acquire(blocking=False)
+        # Kept while its session is still open: not evicted, and losing the
+        # lease flags it without clearing the token its flush is fenced by.
+        assert storage.keep(lock, {})
+        assert lock.linger_until > 0
+        redis.store.redis.delete("job-lock-jid")
+        await storage.renew([lock])
+        assert lock.lost and lock.token is not None
+        waiter = asyncio.ensure_future(storage.enter_session("jid"))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        storage.exit_session("jid")
+        assert await waiter
+        storage.exit_session("jid")
+        assert not storage.sessions
+
+    asyncio.run(run())
+
+
+def make_manager(monkeypatch, concurrency=10):
+    from actions import jobs
+    from actions.embedded import EmbeddedStore
+
+    monkeypatch.setattr(jobs, "store_from_env", EmbeddedStore)
+    manager = jobs.JobsManager(None)
+    manager.check_sem = asyncio.Semaphore(concurrency)
+    return manager
+
+
+def test_scheduler_processes_due_jobs_once(monkeypatch):
+    import time
+
+    async def run():
+        manager = make_manager(monkeypatch)
+        processed = []
+
+        async def process(jid, blocking=True, **kwargs):
+            processed.append(jid)
+
+        manager.process = process
+        now = time.time()
+        await manager.storage.set("due", {"state": "PENDING"}, None, deadline=now - 1)
+        await manager.storage.set("later", {"state": "PENDING"}, None, deadline=now + 60)
+        assert await manager.periodic_check() == 1
+        assert processed == ["due"]
+        # Claimed jobs are pushed out, not handed out twice.
+        assert await manager.periodic_check() == 0
+
+    asyncio.run(run())
+
+
+def test_earlier_local_deadline_wakes_the_scheduler(monkeypatch):
+    import time
+
+    async def run():
+        manager = make_manager(monkeypatch)
+        await manager.storage.set("later", {"state": "PENDING"}, None, deadline=time.time() + 60)
+        sleeper = asyncio.ensure_future(manager.wait_for_next_deadline())
+        await asyncio.sleep(0.01)
+        assert not sleeper.done()
+        # Later than what it sleeps until: no reason to wake up.
+        await manager.storage.set("other", {"state": "PENDING"}, None, deadline=time.time() + 120)
+        await asyncio.sleep(0.01)
+        assert not sleeper.done()
+        await manager.storage.set("soon", {"state": "PENDING"}, None, deadline=time.time())
+        await asyncio.wait_for(sleeper, 1)
+
+    asyncio.run(run())
+
+
+def test_scheduler_batch_stays_within_its_cap(monkeypatch):
+    import time
+
+    async def run():
+        manager = make_manager(monkeypatch, concurrency=2)
+        running, peak = 0, 0
+
+        async def process(jid, blocking=True, **kwargs):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        manager.process = process
+        for i in range(5):
+            await manager.storage.set(f"due{i}", {"state": "PENDING"}, None, deadline=time.time() - 1)
+        assert await manager.periodic_check() == 5
+        assert peak == 2
+        batch = manager.last_batch
+        assert batch.size == 5
+        assert 0.01 <= batch.p50 <= batch.max <= batch.wall
+
+    asyncio.run(run())
@@ -0,0 +1,62 @@
+import orjson
+import pytest
+
+from actions.model import (
+    ActionProperty,
+    ActionSource,
+    ActionTrigger,
+    DataFormat,
+    PropertyKind,
+    pack_properties,
+    pack_trigger,
+    unpack_properties,
+    unpack_trigger,
+)
+
+
+def make_trigger():
+    return ActionTrigger(
+        meta={"entity": "abc"},
+        action_source="LITERAL",
+        action={
+            "kind": "test",
+            "properties": [
+                {"name": "a", "kind": "META_ENTITY", "value": "entity"},
+                {"name": "b", "kind": "PATH", "value": "/x", "data_format": "BYTES", "opaque": True},
+            ],
+        },
+    )
+
+
+def test_stored_trigger_round_trip():
+    trigger = make_trigger()
+    stored = unpack_trigger(pack_trigger(trigger))
+    assert stored.jid == trigger.jid
+    assert stored.meta == trigger.meta
+    assert stored.action_source == ActionSource.LITERAL
+    a, b = stored.action.properties
+    assert a.simplify(stored.meta).value == "/entity/abc"
+    assert b.data_format == DataFormat.BYTES and b.passthrough
+
+
+def test_legacy_values_still_decode():
+    trigger = make_trigger()
+    assert unpack_trigger(trigger.to_bytes()).jid == trigger.jid
+    props = [ActionProperty(name="a", kind="LITERAL", value="v")]
+    (p,) = unpack_properties(ActionProperty.many_to_bytes(props))
+    assert isinstance(p, ActionProperty) and p.kind == PropertyKind.LITERAL
+    (p,) = unpack_properties(pack_properties(props))
+    assert p.value == "v" and p.kind == PropertyKind.LITERAL
+
+
+def test_from_bytes_sniffs_format():
+    trigger = make_trigger()
+    data = trigger.dict()
+    data["action_source"] = "LITERAL"
+    for prop in data["action"]["properties"]:
+        prop["kind"] = prop["kind"].value
+        prop["data_format"] = prop["data_format"].value
+    assert ActionTrigger.from_bytes(orjson.dumps(data)).jid == trigger.jid
+    assert ActionTrigger.from_bytes(memoryview(trigger.to_bytes())).jid == trigger.jid
+    with pytest.raises(ValueError):
+        ActionTrigger.from_bytes(b"{not json")
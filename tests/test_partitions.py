@@ -0,0 +1,73 @@
+from actions.partitions import assign, jid_of, partition_of, partition_subject, response_subject
+
+
+def test_response_subject_round_trips_jid():
+    subject = response_subject("abc123")
+    assert subject == f"conthesis.actions.responses.{partition_of('abc123')}.abc123"
+    assert jid_of(subject) == "abc123"
+
+
+def test_every_partition_has_one_owner():
+    owners = assign(["a", "b", "c"], partitions=64)
+    assert set(owners) == set(range(64))
+    assert set(owners.values()) == {"a", "b", "c"}
+
+
+def test_joining_node_only_takes_partitions():
+    before = assign(["a", "b", "c"], partitions=256)
+    after = assign(["a", "b", "c", "d"], partitions=256)
+    moved = [p for p in before if before[p] != after[p]]
+    assert moved
+    assert all(after[p] == "d" for p in moved)
+
+
+def test_dotted_jid_is_routed_whole():
+    from benchmarks.fakes import subject_matches
+
+    subject = response_subject("order.42")
+    assert subject_matches(partition_subject(partition_of("order.42")), subject)
+    assert jid_of(subject) == "order.42"
+    assert jid_of("conthesis.actions.responses.abc123") == "abc123"
+
+
+def test_partitions_move_without_a_gap():
+    import asyncio
+
+    from actions.embedded import EmbeddedStore
+    from actions.jobs import Storage
+    from actions.partitions import RESPONSE_PARTITIONS, Partitions
+    from benchmarks.fakes import FakeNATS
+
+    async def run():
+        nc = FakeNATS()
+        storage = Storage(EmbeddedStore())
+        gaps = []
+
+        def make_node():
+            async def subscribe(subject, queue=""):
+                return await nc.subscribe(subject, queue=queue, cb=noop)
+
+            return Partitions(storage, nc, subscribe, unsubscribe)
+
+        async def noop(msg):
+            pass
+
+        async def unsubscribe(ssid):
+            await nc.unsubscribe(ssid)
+            # Every partition must still have a subscriber after any drop.
+            subjects = {sub.subject for sub in nc._subs.values()}
+            gaps.extend(p for p in range(RESPONSE_PARTITIONS) if partition_subject(p) not in subjects)
+
+        a, b = make_node(), make_node()
+        await a.setup()
+        assert a.owned == set(range(RESPONSE_PARTITIONS))
+        await b.setup()
+        await a.refresh()
+        assert a.owned and b.owned and a.owned | b.owned == set(range(RESPONSE_PARTITIONS))
+        await a.stop()
+        assert b.owned == set(range(RESPONSE_PARTITIONS))
+        assert await storage.members(0, float("inf")) == [b.node]
+        assert gaps == []
+        await b.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,42 @@
+from actions.retry import RETRY_MAX_ATTEMPTS, CircuitBreaker, RetryPolicy, parse_policies
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_backoff_grows_and_is_capped():
+    policy = RetryPolicy(max_attempts=10, base=1, cap=8)
+    for attempt, ceiling in [(1, 1), (2, 2), (3, 4), (4, 8), (9, 8)]:
+        delay = policy.backoff(attempt)
+        assert ceiling / 2 <= delay <= ceiling
+
+
+def test_parse_policies():
+    policies = parse_policies("slow=3:2:30, fast=8")
+    assert (policies["slow"].max_attempts, policies["slow"].base, policies["slow"].cap) == (3, 2.0, 30.0)
+    assert policies["fast"].max_attempts == 8
+    assert parse_policies("slow")["slow"].max_attempts == RETRY_MAX_ATTEMPTS
+
+
+def test_breaker_opens_and_probes():
+    clock = Clock()
+    b = CircuitBreaker("kind", window=10, min_calls=4, error_rate=0.5, cooldown=5, clock=clock)
+    for ok in [True, False, True, False]:
+        assert b.allow()
+        b.record(ok)
+    assert b.state == "open" and not b.allow()
+    assert b.retry_after() == 5
+    clock.now = 5
+    assert b.allow()
+    assert not b.allow()
+    b.record(False)
+    assert b.state == "open"
+    clock.now = 10
+    assert b.allow()
+    b.record(True)
+    assert b.state == "closed" and b.allow()
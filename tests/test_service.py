@@ -0,0 +1,278 @@
+import asyncio
+
+import msgpack
+
+from actions import service
+from actions.entity_fetcher import EntityFetcher
+from actions.model import ActionProperty, ActionTrigger, PropertyKind
+from actions.service import Service
+from benchmarks.fakes import FakeActionService, FakeCFS, FakeNATS
+
+
+def make_trigger(kind):
+    return ActionTrigger(
+        action_source="LITERAL",
+        action={
+            "kind": kind,
+            "properties": [
+                {"name": "a", "kind": "ENTITY", "value": "e"},
+                {"name": "b", "kind": "LITERAL", "value": "x"},
+            ],
+        },
+    )
+
+
+def test_compute_replies_with_action_result():
+    async def run():
+        nc = FakeNATS()
+
+        async def identity(msg):
+            await nc.publish(msg.reply, msg.data)
+
+        await nc.subscribe("conthesis.action.identity", cb=identity)
+        svc = Service(nc, EntityFetcher(nc))
+        trigger = ActionTrigger(
+            action_source="LITERAL",
+            action={"kind": "identity", "properties": [{"name": "test", "kind": "LITERAL", "value": "test"}]},
+        )
+        assert await svc.compute(trigger) == {"test": "test"}
+
+    asyncio.run(run())
+
+
+def test_compute_coalesces_and_caches_idempotent_kinds(monkeypatch):
+    monkeypatch.setattr(service, "IDEMPOTENT_ACTIONS", {"pure": 60})
+
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc)
+        cfs.put("/cas/e", b'{"v": 1}')
+        cfs.link("/entity/e", "/cas/e")
+        await cfs.setup()
+        plain = FakeActionService(nc, "plain", delay=0.01)
+        pure = FakeActionService(nc, "pure", delay=0.01)
+        await plain.setup()
+        await pure.setup()
+        svc = Service(nc, EntityFetcher(nc))
+
+        results = await asyncio.gather(*[svc.compute(make_trigger("plain")) for _ in range(5)])
+        assert results == [{"ok": True}] * 5
+        assert plain.calls == 1
+        await svc.compute(make_trigger("plain"))
+        assert plain.calls == 2
+
+        await svc.compute(make_trigger("pure"))
+        await svc.compute(make_trigger("pure"))
+        assert pure.calls == 1
+
+    asyncio.run(run())
+
+
+def test_freeze_resolves_link_and_entity_in_one_request():
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc)
+        cfs.put("/cas/e", b'{"v": 1}')
+        cfs.put("/plain", b'{"v": 2}')
+        cfs.link("/entity/e", "/cas/e")
+        await cfs.setup()
+        svc = Service(nc, EntityFetcher(nc, resolve_get=True))
+        linked, plain = await svc.freeze_properties([
+            ActionProperty(name="a", kind="ENTITY", value="e"),
+            ActionProperty(name="b", kind="PATH", value="/plain"),
+        ], {})
+        assert cfs.requests == 2
+        assert linked.value == "/cas/e"
+        assert (plain.kind, plain.value) == (PropertyKind.LITERAL, {"v": 2})
+        assert await svc.resolve_value(linked) == {"v": 1}
+        assert cfs.requests == 2
+
+    asyncio.run(run())
+
+
+def test_passthrough_properties_go_by_reference_when_pinned():
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc)
+        cfs.put("/cas/e", b'{"v": 1}')
+        cfs.link("/entity/e", "/cas/e")
+        cfs.put("/plain", b'{"v": 2}')
+        cfs.put("/raw", b"\x00\x01")
+        await cfs.setup()
+        svc = Service(nc, EntityFetcher(nc))
+        linked, plain, raw = await svc.freeze_properties([
+            ActionProperty(name="a", kind="ENTITY", value="e", opaque=True),
+            ActionProperty(name="b", kind="PATH", value="/plain", opaque=True),
+            ActionProperty(name="c", kind="PATH", value="/raw", data_format="BYTES"),
+        ], {})
+        assert (linked.kind, linked.value) == (PropertyKind.PATH, "/cas/e")
+        # No content address to refer to: JSON is pinned, bytes stay a path.
+        assert (plain.kind, plain.value) == (PropertyKind.LITERAL, {"v": 2})
+        assert (raw.kind, raw.value) == (PropertyKind.PATH, "/raw")
+        resolved = await svc.resolve_properties([linked, plain, raw])
+        assert service.encode_properties(resolved) == (
+            b'{"a":{"$ref":"/cas/e"},"b":{"v":2},"c":{"$ref":"/raw"}}'
+        )
+
+    asyncio.run(run())
+
+
+def test_large_entities_are_frozen_to_the_blob_store(monkeypatch):
+    import hashlib
+
+    from actions.embedded import EmbeddedStore
+
+    monkeypatch.setattr(service, "FREEZE_INLINE_LIMIT", 8)
+
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc)
+        cfs.put("/small", b'{"v": 1}')
+        cfs.put("/large", b'{"v": "large"}')
+        await cfs.setup()
+        svc = Service(nc, EntityFetcher(nc))
+        blobs = EmbeddedStore()
+        small, large = await svc.freeze_properties([
+            ActionProperty(name="a", kind="PATH", value="/small"),
+            ActionProperty(name="b", kind="PATH", value="/large"),
+        ], {}, blobs)
+        assert (small.kind, small.value) == (PropertyKind.LITERAL, {"v": 1})
+        address = hashlib.sha256(b'{"v": "large"}').hexdigest()
+        assert (large.kind, large.value) == (PropertyKind.CAS_POINTER, address)
+        assert await blobs.get_blob(address) == b'{"v": "large"}'
+        # The entity changing afterwards does not reach the frozen property.
+        cfs.put("/large", b'{"v": "changed"}')
+        svc.entity_fetcher.invalidate("/large")
+        assert await svc.resolve_properties([small, large], blobs) == {"a": {"v": 1}, "b": {"v": "large"}}
+
+    asyncio.run(run())
+
+
+def test_compute_does_not_cache_unpinned_paths(monkeypatch):
+    monkeypatch.setattr(service, "IDEMPOTENT_ACTIONS", {"pure": 60})
+
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc)
+        cfs.put("/raw", b"\x00")
+        await cfs.setup()
+        pure = FakeActionService(nc, "pure")
+        await pure.setup()
+        svc = Service(nc, EntityFetcher(nc))
+        trigger = ActionTrigger(
+            action_source="LITERAL",
+            action={"kind": "pure", "properties": [{"name": "a", "kind": "PATH", "value": "/raw", "data_format": "BYTES"}]},
+        )
+        await svc.compute(trigger)
+        await svc.compute(trigger)
+        assert pure.calls == 2
+        assert len(svc.results) == 0
+
+    asyncio.run(run())
+
+
+def test_path_triggers_reuse_the_parsed_action(monkeypatch):
+    parsed = []
+    from_bytes = service.Action.from_bytes
+
+    def counting(data):
+        parsed.append(data)
+        return from_bytes(data)
+
+    monkeypatch.setattr(service.Action, "from_bytes", counting)
+
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc)
+        cfs.put("/cas/v1", b'{"kind": "v1", "properties": []}')
+        cfs.put("/cas/v2", b'{"kind": "v2", "properties": []}')
+        cfs.link("/actions/a", "/cas/v1")
+        await cfs.setup()
+        svc = Service(nc, EntityFetcher(nc))
+        trigger = ActionTrigger(action_source="PATH", action="/actions/a")
+
+        assert (await svc.get_action(trigger)).kind == "v1"
+        assert cfs.requests == 2
+        assert (await svc.get_action(trigger)).kind == "v1"
+        assert cfs.requests == 2
+        assert len(parsed) == 1
+
+        cfs.link("/actions/a", "/cas/v2")
+        assert (await svc.get_action(trigger)).kind == "v1"
+        svc.invalidate_action("/actions/a")
+        assert (await svc.get_action(trigger)).kind == "v2"
+        assert len(parsed) == 2
+
+    asyncio.run(run())
+
+
+def path_properties(*paths):
+    return [ActionProperty(name=str(i), kind="PATH", value=p) for i, p in enumerate(paths)]
+
+
+def test_resolve_fetches_identical_paths_once():
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc, delay=0.01)
+        cfs.put("/a", b'{"v": 1}')
+        await cfs.setup()
+        svc = Service(nc, EntityFetcher(nc))
+        resolved = await svc.resolve_properties(path_properties("/a", "/a", "/a"))
+        assert resolved == {"0": {"v": 1}, "1": {"v": 1}, "2": {"v": 1}}
+        assert cfs.requests == 1
+
+    asyncio.run(run())
+
+
+def test_resolve_caps_concurrent_fetches(monkeypatch):
+    monkeypatch.setattr(service, "RESOLVE_CONCURRENCY", 2)
+
+    async def run():
+        nc = FakeNATS()
+        cfs = FakeCFS(nc, delay=0.01)
+        paths = [f"/e/{i}" for i in range(6)]
+        for path in paths:
+            cfs.put(path, b"1")
+        inflight, peak = 0, 0
+        handle_get = cfs.handle_get
+
+        async def tracking(msg):
+            nonlocal inflight, peak
+            inflight += 1
+            peak = max(peak, inflight)
+            try:
+                await handle_get(msg)
+            finally:
+                inflight -= 1
+
+        cfs.handle_get = tracking
+        await cfs.setup()
+        svc = Service(nc, EntityFetcher(nc))
+        assert await svc.resolve_properties(path_properties(*paths)) == {str(i): 1 for i in range(6)}
+        assert peak == 2
+
+    asyncio.run(run())
+
+
+def test_resolve_prefetches_paths_with_one_multi_get(monkeypatch):
+    monkeypatch.setattr(service, "CFS_MULTI_GET", True)
+
+    async def run():
+        nc = FakeNATS()
+        requests = []
+
+        async def get(msg):
+            requests.append(msg.data)
+            paths = msgpack.unpackb(msg.data)
+            await nc.publish(msg.reply, msgpack.packb([b'{"p": "%s"}' % p for p in paths]))
+
+        await nc.subscribe("conthesis.cfs.get", cb=get)
+        svc = Service(nc, EntityFetcher(nc))
+        resolved = await svc.resolve_properties(path_properties("/a", "/b", "/a"))
+        assert requests == [msgpack.packb([b"/a", b"/b"])]
+        assert resolved == {"0": {"p": "/a"}, "1": {"p": "/b"}, "2": {"p": "/a"}}
+        # Cached entities are left out of the next multi-get.
+        await svc.entity_fetcher.prefetch(["/a", "/c"])
+        assert requests[1:] == [msgpack.packb([b"/c"])]
+
+    asyncio.run(run())
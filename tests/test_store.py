@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+from actions.embedded import EmbeddedStore
+from actions.jobs import StaleLockError, Storage
+from actions.store import RedisStore
+from benchmarks.fakes import FakeRedis
+
+
+def embedded_store():
+    store = EmbeddedStore()
+    return store, lambda jid: store.locks.pop(jid)
+
+
+def redis_store():
+    redis = FakeRedis()
+    return RedisStore(redis), lambda jid: redis.store.redis.delete(f"job-lock-{jid}")
+
+
+@pytest.mark.parametrize("make_store", [redis_store, embedded_store])
+def test_stale_lock_holder_is_fenced_off(make_store):
+    async def run():
+        store, expire_lock = make_store()
+        storage = Storage(store)
+        first = await storage.lock("jid")
+        assert await first.acquire(blocking=False)
+        # The first lease runs out and another worker takes over the job.
+        expire_lock("jid")
+        second = await storage.lock("jid")
+        assert await second.acquire(blocking=False)
+        await storage.set("jid", {"state": "RUNNING"}, None, deadline=10, token=second.token)
+        try:
+            await storage.set("jid", {"state": "FAILURE"}, None, token=first.token)
+            assert False, "stale write went through"
+        except StaleLockError:
+            pass
+        assert await storage.get("jid", "state") == b"RUNNING"
+        assert await storage.claim_due(10, 5, 5) == ["jid"]
+        assert await storage.next_deadline() == 15
+        await second.release()
+        await first.release()
+
+    asyncio.run(run())
+
+
+def test_embedded_store_recovers_from_journal(tmp_path):
+    path = str(tmp_path / "jobs.journal")
+
+    async def run():
+        storage = Storage(EmbeddedStore(path))
+        lock = await storage.lock("a")
+        await lock.acquire(blocking=False)
+        await storage.set("a", {"state": "RUNNING", "x": "1"}, None, deadline=5, token=lock.token)
+        await storage.set("b", {"state": "PENDING"}, None, deadline=7)
+        await storage.set("b", {"state": "SUCCESS"}, b"PENDING")
+        await storage.put_blob("addr", b"blob")
+        await lock.release()
+        storage.store.journal.append(("h", "torn", {}, 0))
+        storage.store.journal.map[storage.store.journal.offset - 1] ^= 0xFF
+        storage.store.close()
+
+        store = EmbeddedStore(path)
+        assert (await store.hgetall(["a"]))[0] == {"lease": b"1", "fence": b"1", "state": b"RUNNING", "x": b"1"}
+        assert store.sets == {"RUNNING": {"a"}, "PENDING": set(), "SUCCESS": {"b"}}
+        assert store.schedule == {"a": 5.0}
+        assert await store.get_blob("addr") == b"blob"
+        assert "torn" not in store.hashes
+        # A new lock continues the fencing sequence.
+        assert await store.acquire_locks(["a"], 1000) == [2]
+
+        store.compact()
+        store.close()
+        store = EmbeddedStore(path)
+        assert (await store.hgetall(["a"]))[0]["lease"] == b"2"
+        assert store.schedule == {"a": 5.0}
+        store.close()
+
+    asyncio.run(run())
+
+
+def test_redis_backfill_adds_a_page_per_round_trip(monkeypatch):
+    from actions import store
+
+    monkeypatch.setattr(store, "BACKFILL_PAGE", 2)
+
+    async def run():
+        redis = FakeRedis()
+        redis.store.redis.sadd("job-state-RUNNING", "a", "b", "c")
+        redis.store.redis.zadd("job-schedule", {"b": 1})
+        await RedisStore(redis).backfill_schedule(["RUNNING"], 5)
+        assert redis.store.redis.zrange("job-schedule", 0, -1, withscores=True) == [
+            (b"b", 1.0), (b"a", 5.0), (b"c", 5.0),
+        ]
+        assert redis.round_trips == 4
+
+    asyncio.run(run())
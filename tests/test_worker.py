@@ -0,0 +1,121 @@
+import asyncio
+
+from benchmarks.bench_worker import parse_args, run
+
+
+def test_jobs_complete_against_fakes():
+    args = parse_args(["--jobs", "50", "--properties", "3", "--timeout", "10"])
+    bench = asyncio.run(run(args))
+    assert len(bench.latencies) == 50
+    assert not bench.started
+
+
+def test_dropped_actions_stay_running():
+    args = parse_args(["--jobs", "20", "--failure-rate", "1", "--timeout", "0.5"])
+    bench = asyncio.run(run(args))
+    assert bench.latencies == []
+    assert bench.action_service.dropped == 20
+
+
+def make_worker(monkeypatch):
+    from actions import jobs
+    from actions.embedded import EmbeddedStore
+    from actions.entity_fetcher import EntityFetcher
+    from actions.service import Service
+    from actions.worker import Worker
+    from benchmarks.fakes import FakeNATS
+
+    monkeypatch.setattr(jobs, "store_from_env", EmbeddedStore)
+    nc = FakeNATS()
+    svc = Service(nc, EntityFetcher(nc))
+    return Worker(nc, svc, jobs.JobsManager(svc))
+
+
+async def request_batch(worker, items):
+    import orjson
+
+    from actions.worker import ASYNC_BATCH_TOPIC
+    from benchmarks.fakes import Msg
+
+    replies = []
+
+    async def on_reply(msg):
+        replies.append(orjson.loads(msg.data))
+
+    await worker.nc.subscribe("_INBOX.batch", cb=on_reply)
+    await worker.handle_async_batch(Msg(ASYNC_BATCH_TOPIC, "_INBOX.batch", orjson.dumps(items)))
+    await asyncio.sleep(0)
+    return replies[0]
+
+
+def literal(jid, kind):
+    return {"jid": jid, "action_source": "LITERAL", "action": {"kind": kind, "properties": []}}
+
+
+def worker_trigger(jid):
+    from actions.model import ActionTrigger
+
+    return ActionTrigger(**literal(jid, "k"))
+
+
+def test_batch_reports_a_status_per_item(monkeypatch):
+    from benchmarks.fakes import FakeActionService
+
+    async def run():
+        worker = make_worker(monkeypatch)
+        k = FakeActionService(worker.nc, "k")
+        k2 = FakeActionService(worker.nc, "k2")
+        await k.setup()
+        await k2.setup()
+        # Another worker holds this job.
+        held = await worker.jobs.storage.lock("held")
+        assert await held.acquire(blocking=False)
+
+        reply = await request_batch(worker, [
+            literal("a", "k"),
+            {"action_source": "NOPE"},
+            literal("held", "k"),
+            literal("a", "k2"),
+        ])
+        assert reply == [
+            {"jid": "a", "status": "ok"},
+            {"jid": None, "status": "invalid"},
+            {"jid": "held", "status": "locked"},
+            {"jid": "a", "status": "duplicate"},
+        ]
+        await asyncio.sleep(0.01)
+        assert (k.calls, k2.calls) == (1, 0)
+        assert await worker.jobs.storage.get("a", "state") == b"RUNNING"
+        assert await worker.jobs.storage.get("held", "state") is None
+
+    asyncio.run(run())
+
+
+def test_empty_batch_gets_an_empty_reply(monkeypatch):
+    async def run():
+        assert await request_batch(make_worker(monkeypatch), []) == []
+
+    asyncio.run(run())
+
+
+def test_batch_failing_to_stage_one_job_still_flushes_the_rest(monkeypatch):
+    from actions import jobs
+
+    close = jobs.JidSession.close
+
+    async def failing_close(self):
+        if self.jid == "bad":
+            raise RuntimeError("boom")
+        await close(self)
+
+    monkeypatch.setattr(jobs.JidSession, "close", failing_close)
+
+    async def run():
+        worker = make_worker(monkeypatch)
+        acks = await worker.jobs.register_many([worker_trigger("bad"), worker_trigger("good")])
+        assert acks == ["error", "ok"]
+        assert await worker.jobs.storage.get("good", "state") is not None
+        assert await worker.jobs.storage.get("bad", "state") is None
+        assert not worker.jobs.storage.sessions
+
+    asyncio.run(run())